@@ -2,12 +2,129 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
+from itertools import chain
+
 from django import forms
 from django.contrib import admin
+from django.contrib.admin.views.main import PAGE_VAR
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import force_bytes
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 from pagedown.widgets import AdminPagedownWidget
 
-from . import models
+from . import models, search
+from .signals import releases_changed
+
+
+def estimate_count(queryset):
+    """
+    Return the planner's estimate of the rows in the table of queryset on
+    PostgreSQL, or None
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return int(row[0]) if row else None
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Caches the count for a short while, and estimates the count of whole
+    tables of more than estimate_over rows, so that paging through a
+    changelist never counts a whole large table
+    """
+    estimate_over = 10000
+    cache_timeout = 60
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        if not queryset.query.where:
+            estimate = estimate_count(queryset)
+            if estimate and estimate > self.estimate_over:
+                return estimate
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = 'admin-count:' + hashlib.md5(force_bytes(
+            repr((sql, params)))).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.cache_timeout)
+        return count
+
+
+class InputFilter(admin.SimpleListFilter):
+    """A list filter that takes the value from a text input"""
+    template = 'admin/rna/input_filter.html'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value() or '',
+            'params': sorted(
+                (k, v) for k, v in changelist.params.items()
+                if k not in (self.parameter_name, PAGE_VAR)),
+            'clear_query_string': changelist.get_query_string(
+                remove=[self.parameter_name]),
+        }
+
+
+def note_ids_for_releases(**kwargs):
+    """
+    Return a subquery of the ids of the notes of the matching releases,
+    which filters notes without a join that would need DISTINCT
+    """
+    return models.Note.releases.through.objects.filter(**dict(
+        ('release__' + k, v) for k, v in kwargs.items())).values('note')
+
+
+class ReleaseVersionFilter(InputFilter):
+    title = 'release version'
+    parameter_name = 'version'
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pk__in=note_ids_for_releases(
+                version=self.value()))
+
+
+class ReleaseProductFilter(admin.SimpleListFilter):
+    title = 'release product'
+    parameter_name = 'product'
+
+    def lookups(self, request, model_admin):
+        return [(p, p) for p in models.Release.PRODUCTS]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pk__in=note_ids_for_releases(
+                product=self.value()))
+
+
+class SearchIndexMixin(object):
+    """Searches with the full-text index where the database has one"""
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.is_indexed(queryset.db):
+            return search.filter_matching(queryset, search_term), False
+        return super(SearchIndexMixin, self).get_search_results(
+            request, queryset, search_term)
 
 
 class NoteAdminForm(forms.ModelForm):
@@ -18,14 +135,24 @@ class NoteAdminForm(forms.ModelForm):
         fields = '__all__'
 
 
-class NoteAdmin(admin.ModelAdmin):
+class NoteAdmin(SearchIndexMixin, admin.ModelAdmin):
     form = NoteAdminForm
     filter_horizontal = ['releases']
     list_display = ('id', 'bug', 'tag', 'note', 'created')
     list_display_links = ('id',)
-    list_filter = ('tag', 'is_known_issue', 'releases__product',
-                   'releases__version')
-    search_fields = ('bug', 'note', 'releases__version')
+    list_filter = ('tag', 'is_known_issue', ReleaseProductFilter,
+                   ReleaseVersionFilter)
+    search_fields = ('bug', 'note')
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        results, use_distinct = super(NoteAdmin, self).get_search_results(
+            request, queryset, search_term)
+        if search_term:
+            results |= queryset.filter(pk__in=note_ids_for_releases(
+                version__icontains=search_term.strip()))
+        return results, use_distinct
 
 
 class ReleaseAdminForm(forms.ModelForm):
@@ -39,7 +166,7 @@ class ReleaseAdminForm(forms.ModelForm):
         fields = '__all__'
 
 
-class ReleaseAdmin(admin.ModelAdmin):
+class ReleaseAdmin(SearchIndexMixin, admin.ModelAdmin):
     actions = ['copy_releases', 'set_to_public']
     form = ReleaseAdminForm
     list_display = ('version', 'product', 'channel', 'is_public',
@@ -47,6 +174,16 @@ class ReleaseAdmin(admin.ModelAdmin):
     list_filter = ('product', 'channel', 'is_public')
     ordering = ('-release_date',)
     search_fields = ('version', 'text')
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        results, use_distinct = super(ReleaseAdmin, self).get_search_results(
+            request, queryset, search_term)
+        if search_term:
+            results |= queryset.filter(
+                version__istartswith=search_term.strip())
+        return results, use_distinct
 
     def url(self, obj):
         base_url_staging = "https://www-dev.allizom.org/en-US"
@@ -74,34 +211,24 @@ class ReleaseAdmin(admin.ModelAdmin):
     url.allow_tags = True
 
     def copy_releases(self, request, queryset):
-        release_count = 0
-        for release in queryset:
-            release_count += 1
-            copy_count = self.model.objects.filter(
-                version__endswith=release.version,
-                product=release.product).count()
-            notes = list(release.note_set.all())
-            copy = release
-            copy.id = None
-            if copy_count > 1:
-                copy.version = 'copy%s-%s' % (copy_count, copy.version)
-            else:
-                copy.version = 'copy-' + copy.version
-            # By default, set it to public. Usually, the copy feature is used
-            # when copying aurora => beta or beta => release. We want to review
-            # it before going live
-            copy.is_public = False
-            copy.save()
-            copy.note_set.add(*notes)
-            copy.note_set.update(modified=now())
-        if release_count == 1:
+        releases = list(queryset)
+        modified = now()
+        copy_ids, note_ids = self.model.objects.copy(releases, modified)
+        # bulk_create() and update() don't send signals
+        releases_changed(chain(copy_ids, self.model.objects.filter(
+            note__in=note_ids).values_list('pk', flat=True)), modified=modified)
+        search.update_index(self.model, copy_ids)
+        if len(releases) == 1:
             self.message_user(request, 'Copied Release')
         else:
-            self.message_user(request, 'Copied %s Releases' % release_count)
+            self.message_user(request, 'Copied %s Releases' % len(releases))
 
     def set_to_public(self, request, queryset):
         """ Set one or several releases to public """
-        queryset.update(is_public=True, modified=now())
+        modified = now()
+        queryset.update(is_public=True, modified=modified)
+        releases_changed(queryset.values_list('pk', flat=True),
+                         modified=modified)
 
 
 admin.site.register(models.Note, NoteAdmin)
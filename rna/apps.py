@@ -0,0 +1,12 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.apps import AppConfig
+
+
+class RNAConfig(AppConfig):
+    name = 'rna'
+
+    def ready(self):
+        from . import signals  # noqa
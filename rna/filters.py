@@ -22,7 +22,7 @@ class TimestampedFilterBackend(DjangoFilterBackend):
             return super(TimestampedFilterBackend, self).get_filter_class(
                 view, queryset=queryset)
 
-        elif queryset and hasattr(queryset, 'model') and issubclass(
+        elif queryset is not None and hasattr(queryset, 'model') and issubclass(
                 queryset.model, models.TimeStampedModel):
             class AutoFilterSet(self.default_filter_set):
                 created_before = ISO8601DateTimeFilter(
@@ -1,34 +1,293 @@
 from __future__ import print_function, unicode_literals
 
+import hashlib
 import json
 import os
 from codecs import open
-from shutil import rmtree
+from multiprocessing import Pool
+from shutil import copy2, rmtree
+from tempfile import mkdtemp
 
 from django.conf import settings
 from django.core.management import BaseCommand
+from django.db import connections
+from django.db.models import Count, Max
 
-from rna.models import Release
+from rna.models import Release, RenderedRelease
+from rna.utils import (compress, ENCODING_EXTENSIONS, get_encodings,
+                       get_last_modified_date, iter_ndjson, Timer)
 
 
-if hasattr(settings, 'RNA_JSON_EXPORT_DIR'):
-    OUTPUT_DIR = settings.RNA_JSON_EXPORT_DIR
-else:
-    OUTPUT_DIR = os.path.join(settings.ROOT, 'json_export')
+CHUNK_SIZE = 100
 
 
-def setup():
-    rmtree(OUTPUT_DIR, ignore_errors=True)
-    os.mkdir(OUTPUT_DIR)
+def get_output_dir():
+    if hasattr(settings, 'RNA_JSON_EXPORT_DIR'):
+        return settings.RNA_JSON_EXPORT_DIR.rstrip(os.sep)
+    return os.path.join(settings.ROOT, 'json_export')
+
+
+def get_state_file(output_dir):
+    return getattr(settings, 'RNA_JSON_EXPORT_STATE_FILE',
+                   output_dir + '.state.json')
+
+
+def get_ndjson_file(output_dir):
+    return getattr(settings, 'RNA_JSON_EXPORT_NDJSON_FILE',
+                   output_dir + '.ndjson')
+
+
+def load_state(state_file):
+    try:
+        with open(state_file, encoding='utf-8') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def save_state(state_file, state):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as fp:
+        json.dump(state, fp, indent=2, sort_keys=True)
+    os.rename(tmp_file, state_file)
+
+
+def get_signatures():
+    """
+    Return a dict of release pk => (slug, signature, shard) where the
+    signature changes whenever the release, any of its notes or any release
+    they were fixed in is modified, or notes are added to or removed from
+    it, and the shard groups releases by product and channel
+    """
+    signatures = {}
+    rows = Release.objects.order_by().annotate(
+        note_count=Count('note'), notes_modified=Max('note__modified'),
+        fixes_modified=Max('note__fixed_in_release__modified')).values_list(
+            'pk', 'slug', 'product', 'channel', 'modified', 'note_count',
+            'notes_modified', 'fixes_modified')
+    for (pk, slug, product, channel, modified, note_count, notes_modified,
+         fixes_modified) in rows:
+        signature = '|'.join([
+            modified.isoformat(), str(note_count),
+            notes_modified.isoformat() if notes_modified else '',
+            fixes_modified.isoformat() if fixes_modified else ''])
+        signatures[str(pk)] = (slug, signature, ' '.join([product, channel]))
+    return signatures
+
+
+def render(release_dict):
+    return json.dumps(release_dict, indent=2, sort_keys=True)
+
+
+def remove_existing(path):
+    """
+    Unlink a file already written to the build directory by a release with
+    the same slug, so that hard links to published files are never
+    written through
+    """
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def link_or_copy(src, dst):
+    remove_existing(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+
+def write_file(path, data):
+    remove_existing(path)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def write_release(path, content):
+    """Write a release file and its compressed copies"""
+    data = content.encode('utf-8')
+    write_file(path, data)
+    for encoding in get_encodings():
+        write_file(path + ENCODING_EXTENSIONS[encoding], compress(data, encoding))
+
+
+def reuse_release(old_path, path):
+    """
+    Link or copy a previously exported release file and its compressed
+    copies, compressing any that the previous export did not write
+    """
+    link_or_copy(old_path, path)
+    for encoding in get_encodings():
+        extension = ENCODING_EXTENSIONS[encoding]
+        if os.path.exists(old_path + extension):
+            link_or_copy(old_path + extension, path + extension)
+        else:
+            with open(old_path, 'rb') as fp:
+                write_file(path + extension, compress(fp.read(), encoding))
+
+
+def reusable_file(output_dir, old, slug):
+    """
+    Return the path of the previously exported file for a release if it
+    can be reused under the given slug, otherwise None
+    """
+    if old and old['slug'] == slug:
+        path = os.path.join(output_dir, '{}.json'.format(slug))
+        if os.path.exists(path):
+            return path
+
+
+def export_releases(pks, build_dir, output_dir, previous):
+    """
+    Write the given releases to build_dir, reusing previously exported files
+    from output_dir whose content did not change. Return a dict of release
+    pk => content hash and the number of files written.
+    """
+    hashes = {}
+    written = 0
+    for i in range(0, len(pks), CHUNK_SIZE):
+        rendered = RenderedRelease.objects.get_json(pks[i:i + CHUNK_SIZE])
+        for pk, data in rendered.items():
+            release = json.loads(data)
+            pk = str(pk)
+            content = render(release)
+            hashes[pk] = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            path = os.path.join(build_dir, '{}.json'.format(release['slug']))
+            old = previous.get(pk)
+            old_path = reusable_file(output_dir, old, release['slug'])
+            if old_path and old.get('hash') == hashes[pk]:
+                # touched, but the content is the same
+                reuse_release(old_path, path)
+                continue
+            write_release(path, content)
+            written += 1
+    return hashes, written
+
+
+def export_shard(args):
+    """Pool worker for export_releases"""
+    shard, pks, build_dir, output_dir, previous = args
+    with Timer() as timer:
+        hashes, written = export_releases(pks, build_dir, output_dir, previous)
+    return shard, hashes, written, timer.elapsed
+
+
+def export_ndjson(path):
+    """
+    Write every release to path as newline-delimited JSON, a chunk of
+    releases at a time, and atomically replace it. Return the number of
+    releases written.
+    """
+    tmp_file = path + '.tmp'
+    count = 0
+    with open(tmp_file, 'w', encoding='utf-8') as fp:
+        for line in iter_ndjson(RenderedRelease.objects.iter_json(),
+                                encoded=True):
+            fp.write(line)
+            count += 1
+    os.rename(tmp_file, path)
+    return count
+
+
+def publish(build_dir, output_dir):
+    """
+    Atomically replace output_dir with a symlink to build_dir, then
+    remove the previously published directory
+    """
+    previous = None
+    if os.path.islink(output_dir):
+        previous = os.path.realpath(output_dir)
+    elif os.path.isdir(output_dir):
+        # a plain directory left by an older, non-atomic export
+        previous = build_dir + '.old'
+        os.rename(output_dir, previous)
+
+    tmp_link = build_dir + '.link'
+    os.symlink(os.path.basename(build_dir), tmp_link)
+    os.rename(tmp_link, output_dir)
+    if previous:
+        rmtree(previous, ignore_errors=True)
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help=('Only rewrite releases that changed since '
+                                  'the last export.'))
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help=('Number of processes to export with. '
+                                  'Releases are sharded by product and channel.'))
+        parser.add_argument('--format', choices=('json', 'ndjson'),
+                            default='json',
+                            help=('json writes a file per release, ndjson a '
+                                  'single file with a release per line.'))
+
     def handle(self, *args, **options):
-        # start fresh
-        setup()
-        releases = Release.objects.all_as_list()
-        for rel in releases:
-            with open(os.path.join(OUTPUT_DIR, '{}.json'.format(rel['slug'])), 'w', encoding='utf-8') as fp:
-                json.dump(rel, fp, indent=2, sort_keys=True)
-
-        print('Exported {} releases'.format(len(releases)))
+        output_dir = get_output_dir()
+        parent_dir = os.path.dirname(output_dir)
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir)
+
+        if options['format'] == 'ndjson':
+            path = get_ndjson_file(output_dir)
+            print('Exported {} releases to {}'.format(export_ndjson(path), path))
+            return
+
+        state_file = get_state_file(output_dir)
+        state = load_state(state_file) if options['incremental'] else None
+        if not os.path.isdir(output_dir):
+            state = None
+        previous = state['releases'] if state else {}
+        watermark = get_last_modified_date()
+
+        build_dir = mkdtemp(prefix=os.path.basename(output_dir) + '.',
+                            dir=parent_dir)
+        os.chmod(build_dir, 0o755)
+
+        releases = {}
+        shards = {}
+        for pk, (slug, signature, shard) in get_signatures().items():
+            old = previous.get(pk)
+            old_path = reusable_file(output_dir, old, slug)
+            if old_path and old['signature'] == signature:
+                reuse_release(old_path, os.path.join(build_dir, '{}.json'.format(slug)))
+                releases[pk] = old
+            else:
+                shards.setdefault(shard, []).append(int(pk))
+                releases[pk] = {'slug': slug, 'signature': signature}
+
+        tasks = [(shard, pks, build_dir, output_dir, previous)
+                 for shard, pks in sorted(shards.items())]
+        if options['workers'] > 1 and len(tasks) > 1:
+            # forked workers must not share the parent's connections
+            connections.close_all()
+            pool = Pool(options['workers'])
+            try:
+                results = list(pool.imap_unordered(export_shard, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [export_shard(task) for task in tasks]
+
+        written = 0
+        for shard, hashes, shard_written, elapsed in sorted(results):
+            print('Exported {}: {} releases ({} written) in {:.2f}s'.format(
+                shard, len(shards[shard]), shard_written, elapsed))
+            written += shard_written
+            for pk in shards[shard]:
+                if str(pk) in hashes:
+                    releases[str(pk)]['hash'] = hashes[str(pk)]
+                else:
+                    # deleted while exporting
+                    del releases[str(pk)]
+
+        publish(build_dir, output_dir)
+        removed = set(r['slug'] for r in previous.values()) - set(r['slug'] for r in releases.values())
+        save_state(state_file, {
+            'watermark': watermark.isoformat() if watermark else None,
+            'releases': releases,
+        })
+
+        print('Exported {} releases ({} written, {} removed)'.format(
+            len(releases), written, len(removed)))
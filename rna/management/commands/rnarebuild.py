@@ -0,0 +1,71 @@
+from __future__ import print_function
+
+from django.core.management import BaseCommand, CommandError
+
+from rna import search
+from rna.models import BugRelease, Note, Release, RenderedRelease, Tombstone
+from rna.utils import reset_last_modified_date
+
+
+CHUNK_SIZE = 100
+
+
+def rebuild_rendered_releases():
+    pks = list(Release.objects.values_list('pk', flat=True))
+    for i in range(0, len(pks), CHUNK_SIZE):
+        RenderedRelease.objects.refresh(pks[i:i + CHUNK_SIZE])
+    RenderedRelease.objects.exclude(release__in=pks).delete()
+    return 'Rendered {} releases'.format(len(pks))
+
+
+def rebuild_bug_releases():
+    pks = list(Release.objects.values_list('pk', flat=True))
+    count = 0
+    for i in range(0, len(pks), CHUNK_SIZE):
+        count += BugRelease.objects.refresh(pks[i:i + CHUNK_SIZE])
+    return 'Indexed {} bugs of {} releases'.format(count, len(pks))
+
+
+def rebuild_last_modified_date():
+    return 'Last modified date is {}'.format(reset_last_modified_date())
+
+
+def rebuild_search_index():
+    if not search.is_indexed():
+        return 'No search index in this database'
+    return 'Indexed {} notes and {} releases'.format(
+        search.rebuild_index(Note), search.rebuild_index(Release))
+
+
+def prune_tombstones():
+    return 'Pruned {} tombstones'.format(Tombstone.objects.prune())
+
+
+REBUILDERS = (
+    ('rendered', rebuild_rendered_releases),
+    ('bugs', rebuild_bug_releases),
+    ('watermark', rebuild_last_modified_date),
+    ('search', rebuild_search_index),
+    ('tombstones', prune_tombstones),
+)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild data derived from releases and notes.'
+
+    def add_arguments(self, parser):
+        # not choices, which Python 2.7 checks against the empty default
+        parser.add_argument('targets', nargs='*',
+                            help=('What to rebuild, of {}. Defaults to '
+                                  'everything.'.format(', '.join(
+                                      name for name, rebuild in REBUILDERS))))
+
+    def handle(self, *args, **options):
+        targets = options['targets']
+        unknown = set(targets) - set(name for name, rebuild in REBUILDERS)
+        if unknown:
+            raise CommandError('Unknown targets: {}'.format(
+                ', '.join(sorted(unknown))))
+        for name, rebuild in REBUILDERS:
+            if not targets or name in targets:
+                print(rebuild())
@@ -1,9 +1,8 @@
 from django.conf import settings
 from django.core.management import BaseCommand
 
-from synctool.functions import sync_data
-
-from rna.utils import get_last_modified_date
+from rna.sync import sync_dump, sync_feed
+from rna.utils import Timer
 
 
 DEFAULT_RNA_SYNC_URL = 'https://nucleus.mozilla.org/rna/sync/'
@@ -16,13 +15,21 @@ class Command(BaseCommand):
                             help='Full URL to RNA Sync endpoint')
         parser.add_argument('-c', '--clean', action='store_true',
                             help='Delete all RNA data before sync.')
+        parser.add_argument('-f', '--feed', action='store_true',
+                            help=('Sync page by page from the changes feed, '
+                                  'resuming where the last sync stopped.'))
         parser.add_argument('--database', default='default',
                             help=('Specifies the database to use, if using a db. '
                                   'Defaults to "default".')),
 
     def handle(self, *args, **options):
-        clean = options['clean']
-        sync_data(url=options['url'],
-                  clean=clean,
-                  last_modified=None if clean else get_last_modified_date(),
-                  api_token=None)
+        if options['feed']:
+            url = options['url'].rstrip('/') + '/changes/'
+            sync = sync_feed
+        else:
+            url = options['url']
+            sync = sync_dump
+        with Timer() as timer:
+            count = sync(url, clean=options['clean'], using=options['database'])
+        self.stdout.write('Applied {} rows from {} in {:.2f}s ({:.0f} rows/s)'.format(
+            count, url, timer.elapsed, count / max(timer.elapsed, 0.001)))
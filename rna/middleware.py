@@ -1,3 +1,16 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from .utils import record_timing, start_timings, stop_timings
+
+
+logger = logging.getLogger('rna.timing')
+
 METHOD_OVERRIDE_HEADER = 'HTTP_X_HTTP_METHOD_OVERRIDE'
 
 
@@ -5,3 +18,66 @@ class PatchOverrideMiddleware(object):
     def process_view(self, request, callback, callback_args, callback_kwargs):
         if request.method == 'POST' and request.META.get(METHOD_OVERRIDE_HEADER) == 'PATCH':
             request.method = 'PATCH'
+
+
+class ServerTimingMiddleware(object):
+    """
+    Reports the number of queries and the time spent in SQL, serializing,
+    encoding and in total for a RNA_SERVER_TIMING_SAMPLE_RATE fraction of
+    requests (all by default), in a Server-Timing header and a JSON line
+    logged to rna.timing.
+
+    List it first in MIDDLEWARE_CLASSES to time the whole request. Streaming
+    responses are timed up to the first byte.
+    """
+    def process_request(self, request):
+        stop_timings()
+        rate = getattr(settings, 'RNA_SERVER_TIMING_SAMPLE_RATE', 1.0)
+        if random.random() >= rate:
+            return
+        request._server_timing = {
+            'start': time.time(),
+            'connections': [(c, len(c.queries_log), c.force_debug_cursor)
+                            for c in connections.all()],
+        }
+        for connection in connections.all():
+            connection.force_debug_cursor = True
+        start_timings()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered to JSON here
+        if hasattr(request, '_server_timing'):
+            with record_timing('encode'):
+                response.render()
+        return response
+
+    def process_response(self, request, response):
+        state = getattr(request, '_server_timing', None)
+        if state is None:
+            return response
+        durations = stop_timings()
+        queries = 0
+        sql = 0.0
+        for connection, start, force_debug_cursor in state['connections']:
+            connection.force_debug_cursor = force_debug_cursor
+            logged = list(connection.queries_log)[start:]
+            queries += len(logged)
+            sql += sum(float(query['time']) for query in logged)
+
+        metrics = [
+            ('db', sql, '{} queries'.format(queries)),
+            ('serialize', durations.get('serialize', 0), None),
+            ('encode', durations.get('encode', 0), None),
+            ('total', time.time() - state['start'], None),
+        ]
+        header = []
+        record = {'method': request.method, 'path': request.path,
+                  'status': response.status_code, 'queries': queries}
+        for name, seconds, desc in metrics:
+            header.append('{};dur={:.1f}'.format(name, seconds * 1000))
+            if desc:
+                header[-1] += ';desc="{}"'.format(desc)
+            record[name + '_ms'] = round(seconds * 1000, 1)
+        response['Server-Timing'] = ', '.join(header)
+        logger.info(json.dumps(record, sort_keys=True))
+        return response
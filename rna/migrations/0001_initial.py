@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Note',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', models.DateTimeField(db_index=True, editable=False, blank=True)),
+                ('bug', models.IntegerField(null=True, blank=True)),
+                ('note', models.TextField(blank=True)),
+                ('is_known_issue', models.BooleanField(default=False)),
+                ('tag', models.CharField(blank=True, max_length=255, choices=[(b'New', b'New'), (b'Changed', b'Changed'), (b'HTML5', b'HTML5'), (b'Feature', b'Feature'), (b'Language', b'Language'), (b'Developer', b'Developer'), (b'Fixed', b'Fixed')])),
+                ('sort_num', models.IntegerField(default=0)),
+                ('is_public', models.BooleanField(default=True)),
+            ],
+            options={
+                'get_latest_by': 'modified',
+            },
+        ),
+        migrations.CreateModel(
+            name='Release',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', models.DateTimeField(db_index=True, editable=False, blank=True)),
+                ('product', models.CharField(max_length=255, choices=[(b'Firefox', b'Firefox'), (b'Firefox for Android', b'Firefox for Android'), (b'Firefox Extended Support Release', b'Firefox Extended Support Release'), (b'Firefox OS', b'Firefox OS'), (b'Thunderbird', b'Thunderbird'), (b'Firefox for iOS', b'Firefox for iOS')])),
+                ('channel', models.CharField(max_length=255, choices=[(b'Nightly', b'Nightly'), (b'Aurora', b'Aurora'), (b'Beta', b'Beta'), (b'Release', b'Release'), (b'ESR', b'ESR')])),
+                ('version', models.CharField(max_length=255)),
+                ('release_date', models.DateTimeField()),
+                ('text', models.TextField(blank=True)),
+                ('is_public', models.BooleanField(default=False)),
+                ('bug_list', models.TextField(blank=True)),
+                ('bug_search_url', models.CharField(max_length=2000, blank=True)),
+                ('system_requirements', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ('product', '-version', 'channel'),
+                'get_latest_by': 'modified',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='release',
+            unique_together=set([('product', 'version')]),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='fixed_in_release',
+            field=models.ForeignKey(related_name='fixed_note_set', blank=True, to='rna.Release', null=True),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='releases',
+            field=models.ManyToManyField(to='rna.Release', blank=True),
+        ),
+    ]
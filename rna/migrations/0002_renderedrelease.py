@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderedRelease',
+            fields=[
+                ('release', models.OneToOneField(related_name='rendered', primary_key=True, serialize=False, to='rna.Release')),
+                ('data', models.TextField()),
+                ('source_modified', models.DateTimeField()),
+            ],
+        ),
+    ]
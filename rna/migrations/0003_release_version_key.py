@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from rna.models import get_version_key
+
+
+def set_version_keys(apps, schema_editor):
+    Release = apps.get_model('rna', 'Release')
+    for release in Release.objects.only('version').iterator():
+        Release.objects.filter(pk=release.pk).update(
+            version_key=get_version_key(release.version))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0002_renderedrelease'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='release',
+            options={'ordering': ('product', '-version_key', 'channel', '-version'), 'get_latest_by': 'modified'},
+        ),
+        migrations.AddField(
+            model_name='release',
+            name='version_key',
+            field=models.CharField(db_index=True, max_length=255, editable=False, blank=True),
+        ),
+        migrations.RunPython(set_version_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_version_majors(apps, schema_editor):
+    Release = apps.get_model('rna', 'Release')
+    for release in Release.objects.only('version').iterator():
+        Release.objects.filter(pk=release.pk).update(
+            version_major=release.version.split('.', 1)[0])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0003_release_version_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='release',
+            name='version_major',
+            field=models.CharField(max_length=255, editable=False, blank=True),
+        ),
+        migrations.RunPython(set_version_majors, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='release',
+            index_together=set([('product', 'channel', 'version_major', 'is_public', 'version_key')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0004_release_version_major'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='note',
+            index_together=set([('sort_num', 'created')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0006_sync_feed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='etag',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='last_modified',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+    ]
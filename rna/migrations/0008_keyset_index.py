@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0007_syncstate_validators'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='note',
+            index_together=set([('sort_num', 'created'), ('modified', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='release',
+            index_together=set([('modified', 'id'), ('product', 'channel', 'version_major', 'is_public', 'version_key')]),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, OperationalError, transaction
+
+
+NOTE_DOCUMENT = "COALESCE(CAST(bug AS text), '') || ' ' || note"
+RELEASE_DOCUMENT = "product || ' ' || version || ' ' || channel || ' ' || text"
+
+SQLITE_SQL = [
+    'CREATE VIRTUAL TABLE rna_note_search USING fts5(text)',
+    'CREATE VIRTUAL TABLE rna_release_search USING fts5(text)',
+    'INSERT INTO rna_note_search (rowid, text) '
+    'SELECT id, {} FROM rna_note'.format(NOTE_DOCUMENT),
+    'INSERT INTO rna_release_search (rowid, text) '
+    'SELECT id, {} FROM rna_release'.format(RELEASE_DOCUMENT),
+]
+
+POSTGRESQL_SQL = []
+for name, document in (('note', NOTE_DOCUMENT), ('release', RELEASE_DOCUMENT)):
+    POSTGRESQL_SQL.extend([
+        'CREATE TABLE rna_{0}_search (object_id integer PRIMARY KEY, '
+        'text text NOT NULL, document tsvector NOT NULL)'.format(name),
+        'CREATE INDEX rna_{0}_search_document ON rna_{0}_search '
+        'USING gin(document)'.format(name),
+        "INSERT INTO rna_{0}_search (object_id, text, document) "
+        "SELECT id, {1}, to_tsvector('english', {1}) FROM rna_{0}".format(
+            name, document),
+    ])
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create and fill the index tables on databases that support them. The
+    index is left out on SQLite builds without FTS5.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        try:
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    for sql in SQLITE_SQL:
+                        cursor.execute(sql)
+        except OperationalError:
+            pass
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            for sql in POSTGRESQL_SQL:
+                cursor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor in ('sqlite', 'postgresql'):
+        with connection.cursor() as cursor:
+            for name in ('note', 'release'):
+                cursor.execute('DROP TABLE IF EXISTS rna_{}_search'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0008_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from rna.models import parse_bug_list
+
+
+def add_bug_releases(apps, schema_editor):
+    Release = apps.get_model('rna', 'Release')
+    Note = apps.get_model('rna', 'Note')
+    BugRelease = apps.get_model('rna', 'BugRelease')
+    rows = set()
+    for pk, bug_list in Release.objects.values_list('pk', 'bug_list').iterator():
+        rows.update((bug, pk) for bug in parse_bug_list(bug_list))
+    rows.update(Note.releases.through.objects.filter(
+        note__bug__isnull=False).values_list('note__bug', 'release'))
+    BugRelease.objects.bulk_create(
+        [BugRelease(bug=bug, release_id=pk) for bug, pk in sorted(rows)],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BugRelease',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('bug', models.IntegerField()),
+                ('release', models.ForeignKey(related_name='bugs', to='rna.Release')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='bugrelease',
+            unique_together=set([('bug', 'release')]),
+        ),
+        migrations.RunPython(add_bug_releases, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from rna.models import get_slug
+
+
+def set_slugs(apps, schema_editor):
+    Release = apps.get_model('rna', 'Release')
+    for release in Release.objects.only(
+            'product', 'version', 'channel').iterator():
+        Release.objects.filter(pk=release.pk).update(slug=get_slug(
+            release.product, release.version, release.channel))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rna', '0010_bug_release'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='release',
+            name='slug',
+            field=models.CharField(max_length=255, null=True, editable=False),
+        ),
+        migrations.RunPython(set_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='release',
+            name='slug',
+            field=models.CharField(max_length=255, editable=False, db_index=True),
+        ),
+    ]
@@ -2,16 +2,56 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
+import re
+from datetime import timedelta
 from itertools import chain
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import (Case, IntegerField, Prefetch, Q, Sum, Value,
+                              When)
+from django.db.models.functions import Substr
 from django.forms.models import model_to_dict
 from django.utils.text import slugify
 from django.utils.timezone import now
 from django_extensions.db.fields import CreationDateTimeField
 
 
+VERSION_RE = re.compile(
+    r'(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:\.\d+)*(a|beta|b|esr)?(\d*)', re.I)
+VERSION_SUFFIX_RANKS = {'a': 1, 'b': 2, 'beta': 2, '': 3, 'esr': 4}
+BUG_RE = re.compile(r'\b(\d{4,})\b')
+MAX_BUG = 2 ** 31 - 1
+
+
+def get_version_key(version):
+    """
+    Return a string that sorts versions numerically by major, minor and
+    patch number, then alphas before betas before releases before ESRs
+    """
+    match = VERSION_RE.search(version)
+    if not match:
+        return ''
+    major, minor, patch, suffix, suffix_num = match.groups()
+    return '{:06d}.{:06d}.{:06d}.{}.{:06d}'.format(
+        int(major), int(minor or 0), int(patch or 0),
+        VERSION_SUFFIX_RANKS[(suffix or '').lower()], int(suffix_num or 0))
+
+
+def get_slug(product, version, channel):
+    """
+    Return the slug of a release, with Firefox ESR releases under firefox
+    and the esr channel
+    """
+    product = slugify(product)
+    channel = channel.lower()
+    if product.lower() == 'firefox-extended-support-release':
+        product = 'firefox'
+        channel = 'esr'
+    return '-'.join([product, version, channel])
+
+
 class TimeStampedModel(models.Model):
     """
     Replacement for django_extensions.db.models.TimeStampedModel
@@ -32,9 +72,99 @@ class TimeStampedModel(models.Model):
 
 
 class ReleaseManager(models.Manager):
+    def with_sorted_notes(self):
+        """
+        Return all releases with their notes prefetched in the order
+        Release.notes() expects, along with each note's fixed_in_release,
+        so that serializing them takes a fixed number of queries
+        """
+        notes = Note.objects.select_related('fixed_in_release').order_by(
+            '-sort_num', 'created')
+        return self.prefetch_related(
+            Prefetch('note_set', queryset=notes, to_attr='sorted_notes'))
+
     def all_as_list(self):
         """Return all releases as a list of dicts"""
-        return [r.to_dict() for r in self.prefetch_related('note_set').all()]
+        return [r.to_dict() for r in self.with_sorted_notes()]
+
+    def get_by_slug(self, slug, queryset=None):
+        """
+        Return the release with the given slug, of queryset if given, or
+        None. Releases of different products can share a slug, and the
+        oldest of them is returned.
+        """
+        if queryset is None:
+            queryset = self.all()
+        return queryset.filter(slug=slug).order_by('pk').first()
+
+    def copy_counts(self, releases, chunk_size=200):
+        """
+        Return a dict of release pk => the number of releases of its product
+        whose version ends with its version, counting it, with one
+        aggregate query per chunk of releases
+        """
+        counts = {}
+        for i in range(0, len(releases), chunk_size):
+            counts.update(self.aggregate(**dict(
+                ('copies_{}'.format(r.pk), Sum(Case(
+                    When(product=r.product, version__endswith=r.version,
+                         then=Value(1)),
+                    default=Value(0), output_field=IntegerField())))
+                for r in releases[i:i + chunk_size])))
+        return dict((r.pk, counts['copies_{}'.format(r.pk)]) for r in releases)
+
+    def copy(self, releases, modified):
+        """
+        Create private copies of releases with their notes, named
+        copy-<version>, or copyN-<version> if N releases of the product end
+        with the version, in a fixed number of queries. Set the notes'
+        modified date and return the pks of the copies and the notes.
+        """
+        with transaction.atomic(using=self.db):
+            # so that concurrent copies of the same products number their
+            # copies one after the other, where the database can lock
+            list(self.select_for_update().filter(
+                product__in=set(r.product for r in releases)).order_by(
+                    'pk').values_list('pk', flat=True))
+            counts = self.copy_counts(releases)
+            fields = [f for f in self.model._meta.concrete_fields if not f.primary_key]
+            copies = []
+            for release in releases:
+                # copies made earlier in this batch count too
+                earlier = [c.version for c in copies if c.product == release.product]
+                count = counts[release.pk] + len(
+                    [v for v in earlier if v.endswith(release.version)])
+                copy = self.model(**dict((f.attname, getattr(release, f.attname))
+                                         for f in fields))
+                if count > 1:
+                    copy.version = 'copy%s-%s' % (count, release.version)
+                else:
+                    copy.version = 'copy-' + release.version
+                # By default, set it to public. Usually, the copy feature is used
+                # when copying aurora => beta or beta => release. We want to review
+                # it before going live
+                copy.is_public = False
+                copy.modified = modified
+                copy.set_stored_fields()
+                copies.append(copy)
+
+            through = Note.releases.through
+            self.bulk_create(copies)
+            # bulk_create doesn't set the pks
+            created = dict(((product, version), pk) for pk, product, version in
+                           self.filter(version__in=[c.version for c in copies],
+                                       product__in=set(c.product for c in copies)
+                                       ).values_list('pk', 'product', 'version'))
+            copy_ids = dict((r.pk, created[(c.product, c.version)])
+                            for r, c in zip(releases, copies))
+            rows = list(through.objects.filter(release__in=copy_ids).values_list(
+                'release', 'note'))
+            through.objects.bulk_create([
+                through(release_id=copy_ids[release_id], note_id=note_id)
+                for release_id, note_id in rows])
+            note_ids = sorted(set(note_id for release_id, note_id in rows))
+            Note.objects.filter(pk__in=note_ids).update(modified=modified)
+            return sorted(copy_ids.values()), note_ids
 
 
 class Release(TimeStampedModel):
@@ -48,6 +178,11 @@ class Release(TimeStampedModel):
     channel = models.CharField(max_length=255,
                                choices=[(c, c) for c in CHANNELS])
     version = models.CharField(max_length=255)
+    version_key = models.CharField(max_length=255, blank=True, editable=False,
+                                   db_index=True)
+    version_major = models.CharField(max_length=255, blank=True,
+                                     editable=False)
+    slug = models.CharField(max_length=255, editable=False, db_index=True)
     release_date = models.DateTimeField()
     text = models.TextField(blank=True)
     is_public = models.BooleanField(default=False)
@@ -57,14 +192,15 @@ class Release(TimeStampedModel):
 
     objects = ReleaseManager()
 
-    @property
-    def slug(self):
-        product = slugify(self.product)
-        channel = self.channel.lower()
-        if product.lower() == 'firefox-extended-support-release':
-            product = 'firefox'
-            channel = 'esr'
-        return '-'.join([product, self.version, channel])
+    def set_stored_fields(self):
+        """Set the fields derived from the others, as saving does"""
+        self.version_key = get_version_key(self.version)
+        self.version_major = self.major_version()
+        self.slug = get_slug(self.product, self.version, self.channel)
+
+    def save(self, *args, **kwargs):
+        self.set_stored_fields()
+        super(Release, self).save(*args, **kwargs)
 
     def major_version(self):
         return self.version.split('.', 1)[0]
@@ -98,15 +234,11 @@ class Release(TimeStampedModel):
         or None if no such releases exist
         """
         releases = self._default_manager.filter(
-            version__startswith=self.major_version() + '.',
-            channel=self.channel, product=product).order_by('-version')
+            product=product, channel=self.channel,
+            version_major=self.major_version())
         if not getattr(settings, 'DEV', False):
             releases = releases.filter(is_public=True)
-        if releases:
-            return sorted(
-                sorted(releases, reverse=True,
-                       key=lambda r: len(r.version.split('.'))),
-                reverse=True, key=lambda r: r.version.split('.')[1])[0]
+        return releases.order_by('-version_key', '-version').first()
 
     def equivalent_android_release(self):
         if self.product == 'Firefox':
@@ -127,10 +259,42 @@ class Release(TimeStampedModel):
         any note with the fixed tag that starts with the release version to
         the top, for what we call "dot fixes".
         """
-        tag_index = dict((tag, i) for i, tag in enumerate(Note.TAGS))
-        notes = self.note_set.order_by('-sort_num', 'created')
+        if hasattr(self, 'sorted_notes'):
+            # prefetched by ReleaseManager.with_sorted_notes()
+            return self._group_sorted_notes(public_only)
+
+        # the same grouping and sorting as _group_sorted_notes, in one query
+        known_issue = Q(is_known_issue=True) & ~Q(fixed_in_release=self.id)
+        notes = self.note_set.annotate(
+            # not note__startswith, as LIKE ignores case on some databases
+            note_start=Substr('note', 1, len(self.version)),
+        ).annotate(
+            known_issue=Case(
+                When(known_issue, then=Value(1)),
+                default=Value(0), output_field=IntegerField()),
+            dot_fix=Case(
+                When(known_issue, then=Value(0)),
+                When(tag='Fixed', note_start=self.version, then=Value(1)),
+                default=Value(0), output_field=IntegerField()),
+            tag_order=Case(
+                When(known_issue, then=Value(0)),
+                *[When(tag=tag, then=Value(i)) for i, tag in enumerate(Note.TAGS)],
+                default=Value(0), output_field=IntegerField()),
+        ).order_by('known_issue', '-dot_fix', 'tag_order', '-sort_num', 'created')
         if public_only:
             notes = notes.filter(is_public=True)
+        new_features = []
+        known_issues = []
+        for note in notes:
+            (known_issues if note.known_issue else new_features).append(note)
+
+        return new_features, known_issues
+
+    def _group_sorted_notes(self, public_only):
+        tag_index = dict((tag, i) for i, tag in enumerate(Note.TAGS))
+        notes = self.sorted_notes
+        if public_only:
+            notes = [n for n in notes if n.is_public]
         known_issues = [n for n in notes if n.is_known_issue_for(self)]
         new_features = sorted(
             sorted(
@@ -155,6 +319,49 @@ class Release(TimeStampedModel):
         data['notes'] = [n.to_dict(self) for n in chain(new_features, known_issues)]
         return data
 
+    def diff(self, other):
+        """
+        Return a dict of what changed from this release to other: the
+        fields that differ, as [old, new], the notes added, the ids of the
+        notes removed, and the notes whose known issue status changed. The
+        notes are compared with set operations on Note.releases in the
+        database, so only the differences are loaded.
+        """
+        fields = model_to_dict(self, exclude=['id'])
+        other_fields = model_to_dict(other, exclude=['id'])
+        for data, release in ((fields, self), (other_fields, other)):
+            data['release_date'] = release.release_date.date().isoformat()
+
+        through = Note.releases.through
+        note_ids = through.objects.filter(release=self).values('note')
+        other_note_ids = through.objects.filter(release=other).values('note')
+        added = Note.objects.filter(pk__in=other_note_ids).exclude(
+            pk__in=note_ids).select_related('fixed_in_release').order_by(
+                '-sort_num', 'created')
+        removed = Note.objects.filter(pk__in=note_ids).exclude(
+            pk__in=other_note_ids).order_by('pk').values_list('pk', flat=True)
+        # only a known issue fixed in one of them can differ between them
+        changed = [note for note in Note.objects.filter(
+            pk__in=note_ids).filter(
+                pk__in=other_note_ids, is_known_issue=True,
+                fixed_in_release__in=[self.pk, other.pk]).order_by('pk')
+            if note.is_known_issue_for(self) != note.is_known_issue_for(other)]
+
+        return {
+            'from': self.to_simple_dict(),
+            'to': other.to_simple_dict(),
+            'fields': dict((name, [value, other_fields[name]])
+                           for name, value in fields.items()
+                           if value != other_fields[name]),
+            'notes_added': [n.to_dict(other) for n in added],
+            'notes_removed': list(removed),
+            'notes_changed': [{
+                'id': note.pk,
+                'is_known_issue': [note.is_known_issue_for(self),
+                                   note.is_known_issue_for(other)],
+            } for note in changed],
+        }
+
     def to_simple_dict(self):
         """Return a dict of only the basic data about the release"""
         return {
@@ -171,8 +378,13 @@ class Release(TimeStampedModel):
             product=self.product, version=self.version, channel=self.channel)
 
     class Meta:
-        # TODO: see if this has a significant performance impact
-        ordering = ('product', '-version', 'channel')
+        ordering = ('product', '-version_key', 'channel', '-version')
+        index_together = (
+            # for equivalent_release_for_product()
+            ('product', 'channel', 'version_major', 'is_public', 'version_key'),
+            # for KeysetPagination
+            ('modified', 'id'),
+        )
         unique_together = (('product', 'version'),)
         get_latest_by = 'modified'
 
@@ -193,7 +405,7 @@ class Note(TimeStampedModel):
     is_public = models.BooleanField(default=True)
 
     def is_known_issue_for(self, release):
-        return self.is_known_issue and self.fixed_in_release != release
+        return self.is_known_issue and self.fixed_in_release_id != release.id
 
     def to_dict(self, release=None):
         data = model_to_dict(self, exclude=[
@@ -217,3 +429,159 @@ class Note(TimeStampedModel):
 
     class Meta:
         get_latest_by = 'modified'
+        index_together = (
+            # for ReleaseManager.with_sorted_notes()
+            ('sort_num', 'created'),
+            # for KeysetPagination
+            ('modified', 'id'),
+        )
+
+
+class RenderedReleaseManager(models.Manager):
+    def refresh(self, release_ids):
+        """
+        Render and store the JSON of the given releases, returning a dict
+        of release id => JSON
+        """
+        rendered = {}
+        stored = []
+        for release in Release.objects.db_manager(
+                self.db).with_sorted_notes().filter(pk__in=release_ids):
+            data = json.dumps(release.to_dict())
+            source_modified = max(
+                [release.modified] + [n.modified for n in release.sorted_notes])
+            rendered[release.pk] = data
+            stored.append(self.model(release=release, data=data,
+                                     source_modified=source_modified))
+        try:
+            with transaction.atomic(using=self.db):
+                self.filter(release__in=release_ids).delete()
+                self.bulk_create(stored)
+        except IntegrityError:
+            # another request stored some of them first, as requests that
+            # read missing releases render them too
+            for obj in stored:
+                self.filter(release=obj.release_id).update(
+                    data=obj.data, source_modified=obj.source_modified)
+        return rendered
+
+    def get_json(self, release_ids):
+        """
+        Return a dict of release id => stored JSON for the given releases,
+        rendering any that are missing
+        """
+        rendered = dict(self.filter(release__in=release_ids).values_list(
+            'release', 'data'))
+        missing = [pk for pk in release_ids if pk not in rendered]
+        if missing:
+            rendered.update(self.refresh(missing))
+        return rendered
+
+    def iter_json(self, chunk_size=500):
+        """
+        Yield the stored JSON of every release in the default Release
+        ordering
+        """
+        pks = list(Release.objects.values_list('pk', flat=True))
+        for i in range(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            rendered = self.get_json(chunk)
+            for pk in chunk:
+                if pk in rendered:
+                    yield rendered[pk]
+
+
+class RenderedRelease(models.Model):
+    """
+    The JSON of Release.to_dict(), kept up to date by the handlers in
+    rna.signals so that exports don't have to render every release
+    """
+    release = models.OneToOneField(Release, primary_key=True,
+                                   related_name='rendered')
+    data = models.TextField()
+    source_modified = models.DateTimeField()
+
+    objects = RenderedReleaseManager()
+
+
+def parse_bug_list(bug_list):
+    """Return the set of bug numbers in a release's free text bug_list"""
+    return set(bug for bug in (int(b) for b in BUG_RE.findall(bug_list))
+               if bug <= MAX_BUG)
+
+
+class BugReleaseManager(models.Manager):
+    def refresh(self, release_ids):
+        """
+        Replace the bugs of the given releases with those in their bug_list
+        and the bugs of their notes
+        """
+        release_ids = list(release_ids)
+        rows = set()
+        for pk, bug_list in Release.objects.db_manager(self.db).filter(
+                pk__in=release_ids).values_list('pk', 'bug_list'):
+            rows.update((bug, pk) for bug in parse_bug_list(bug_list))
+        rows.update(Note.releases.through.objects.using(self.db).filter(
+            release__in=release_ids, note__bug__isnull=False).values_list(
+                'note__bug', 'release'))
+        with transaction.atomic(using=self.db):
+            self.filter(release__in=release_ids).delete()
+            self.bulk_create([self.model(bug=bug, release_id=pk)
+                              for bug, pk in sorted(rows)])
+        return len(rows)
+
+
+class BugRelease(models.Model):
+    """
+    A bug fixed in a release, from its bug_list or its notes, kept up to
+    date by the handlers in rna.signals
+    """
+    bug = models.IntegerField()
+    release = models.ForeignKey(Release, related_name='bugs')
+
+    objects = BugReleaseManager()
+
+    class Meta:
+        # also the index for looking up the releases of a bug
+        unique_together = (('bug', 'release'),)
+
+
+class TombstoneManager(models.Manager):
+    def prune(self, days=None):
+        """
+        Delete the tombstones older than days, or RNA_TOMBSTONE_RETENTION
+        days. Return the number deleted.
+        """
+        if days is None:
+            days = getattr(settings, 'RNA_TOMBSTONE_RETENTION', 90)
+        tombstones = self.filter(modified__lt=now() - timedelta(days=days))
+        count = tombstones.count()
+        tombstones.delete()
+        return count
+
+
+class Tombstone(TimeStampedModel):
+    """A deleted Release or Note, for the delta feed in rna.sync"""
+    model_label = models.CharField(max_length=255)
+    object_id = models.IntegerField()
+
+    objects = TombstoneManager()
+
+
+class SyncState(models.Model):
+    """
+    Where rna.sync got to in the feed or dump at url, with the validators
+    of the last response to make the next request conditional
+    """
+    url = models.CharField(max_length=255, unique=True)
+    cursor = models.CharField(max_length=255, blank=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=255, blank=True)
+
+
+class Watermark(models.Model):
+    """
+    The date of the last change to releases and notes, including deletes
+    and changed note links, in a single row kept by rna.utils
+    """
+    modified = models.DateTimeField()
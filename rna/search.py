@@ -0,0 +1,205 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A full-text index of notes and releases, in FTS5 tables on SQLite and
+tables of GIN-indexed tsvectors on PostgreSQL, created by migration 0009.
+
+Each indexed row is keyed by the id of its note or release, and its
+document is built from the row in SQL, so that updating the index is a
+delete and an INSERT ... SELECT. Databases without an index fall back to
+icontains lookups.
+"""
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Q
+
+
+CONFIG = 'english'
+CHUNK_SIZE = 500
+SNIPPET_WORDS = 16
+
+INDEXES = {
+    'note': {
+        'index_table': 'rna_note_search',
+        'document': "COALESCE(CAST(bug AS text), '') || ' ' || note",
+        'fields': ('note',),
+    },
+    'release': {
+        'index_table': 'rna_release_search',
+        'document': ("product || ' ' || version || ' ' || channel || ' ' || "
+                     "text"),
+        'fields': ('version', 'text'),
+    },
+}
+
+# per database alias, whether the index tables exist
+_indexed = {}
+
+
+def get_index(model):
+    return INDEXES[model._meta.model_name]
+
+
+def is_indexed(using=DEFAULT_DB_ALIAS):
+    """Whether the database has the index tables"""
+    if using not in _indexed:
+        connection = connections[using]
+        tables = set(index['index_table'] for index in INDEXES.values())
+        _indexed[using] = False
+        if connection.vendor in ('sqlite', 'postgresql'):
+            _indexed[using] = tables <= set(
+                connection.introspection.table_names())
+    return _indexed[using]
+
+
+def _pk_sql(connection):
+    return 'rowid' if connection.vendor == 'sqlite' else 'object_id'
+
+
+def _insert_sql(connection, model, where):
+    index = get_index(model)
+    if connection.vendor == 'sqlite':
+        return ('INSERT INTO {index_table} (rowid, text) '
+                'SELECT id, {document} FROM {table}{where}').format(
+                    table=model._meta.db_table, where=where, **index)
+    return ("INSERT INTO {index_table} (object_id, text, document) "
+            "SELECT id, {document}, to_tsvector('{config}', {document}) "
+            "FROM {table}{where}").format(
+                table=model._meta.db_table, where=where, config=CONFIG,
+                **index)
+
+
+def update_index(model, pks, using=DEFAULT_DB_ALIAS):
+    """
+    Reindex the notes or releases with the given pks, dropping those that
+    no longer exist
+    """
+    pks = list(pks)
+    if not pks or not is_indexed(using):
+        return
+    connection = connections[using]
+    index_table = get_index(model)['index_table']
+    with connection.cursor() as cursor:
+        for i in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[i:i + CHUNK_SIZE]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                index_table, _pk_sql(connection), placeholders), chunk)
+            cursor.execute(_insert_sql(connection, model, ' WHERE id IN ({})'.format(
+                placeholders)), chunk)
+
+
+def clear_index(using=DEFAULT_DB_ALIAS):
+    """Drop every note and release from the index"""
+    if not is_indexed(using):
+        return
+    with connections[using].cursor() as cursor:
+        for index in INDEXES.values():
+            cursor.execute('DELETE FROM {}'.format(index['index_table']))
+
+
+def rebuild_index(model, using=DEFAULT_DB_ALIAS):
+    """Reindex all notes or releases. Return the number indexed."""
+    if not is_indexed(using):
+        return 0
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {}'.format(get_index(model)['index_table']))
+        cursor.execute(_insert_sql(connection, model, ''))
+    return model.objects.using(using).count()
+
+
+def _terms(query, prefix=False):
+    # quoted, so that FTS5 query syntax is matched literally
+    return ' '.join('"{}"{}'.format(term.replace('"', '""'),
+                                    '*' if prefix else '')
+                    for term in query.split())
+
+
+def _prefix_tsquery(query):
+    # each word quoted as a lexeme, so that tsquery syntax is literal
+    return ' & '.join("'{}':*".format(
+        term.replace('\\', '\\\\').replace("'", "''"))
+        for term in query.split())
+
+
+def match_sql(connection, query):
+    """
+    Return the SQL selecting (pk, rank, snippet) of the rows matching query,
+    best first, and its params. Each word of the query must match.
+    """
+    if connection.vendor == 'sqlite':
+        return ("SELECT rowid, -bm25({index_table}), "
+                "snippet({index_table}, 0, '**', '**', '...', {words}) "
+                "FROM {index_table} WHERE {index_table} MATCH %s "
+                "ORDER BY bm25({index_table})"), [_terms(query)]
+    return ("SELECT object_id, ts_rank(document, query), "
+            "ts_headline('{config}', text, query, "
+            "'StartSel=**, StopSel=**, MaxWords={words}, MinWords=4') "
+            "FROM {index_table}, plainto_tsquery('{config}', %s) query "
+            "WHERE document @@ query ORDER BY 2 DESC"), [query]
+
+
+def search(model, query, limit=None, using=DEFAULT_DB_ALIAS):
+    """
+    Return a list of (pk, rank, snippet) of the notes or releases matching
+    every word of query, best first. Without an index, matches are in no
+    particular order and their snippet is the start of the text.
+    """
+    if not query.split():
+        return []
+    index = get_index(model)
+    if not is_indexed(using):
+        q = Q()
+        for term in query.split():
+            q &= reduce(lambda a, b: a | b, [
+                Q(**{field + '__icontains': term}) for field in index['fields']])
+        rows = model.objects.using(using).filter(q).values_list(
+            'pk', index['fields'][-1])
+        if limit:
+            rows = rows[:limit]
+        return [(pk, 0, ' '.join(text.split()[:SNIPPET_WORDS]))
+                for pk, text in rows]
+
+    connection = connections[using]
+    sql, params = match_sql(connection, query)
+    sql = sql.format(index_table=index['index_table'], config=CONFIG,
+                     words=SNIPPET_WORDS)
+    if limit:
+        sql += ' LIMIT %s'
+        params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def search_ids(model, query, using=DEFAULT_DB_ALIAS):
+    """Return the pks of all notes or releases matching query"""
+    return [pk for pk, rank, snippet in search(model, query, using=using)]
+
+
+def filter_matching(queryset, query):
+    """
+    Filter queryset to the notes or releases with words starting with every
+    word of query, with a subquery of the index rather than a list of their
+    pks
+    """
+    if not query.split():
+        return queryset.none()
+    if not is_indexed(queryset.db):
+        return queryset.filter(pk__in=search_ids(
+            queryset.model, query, using=queryset.db))
+    connection = connections[queryset.db]
+    index_table = get_index(queryset.model)['index_table']
+    if connection.vendor == 'sqlite':
+        match = '{0} MATCH %s'.format(index_table)
+        params = [_terms(query, prefix=True)]
+    else:
+        match = "document @@ to_tsquery('{0}', %s)".format(CONFIG)
+        params = [_prefix_tsquery(query)]
+    where = '{0}.id IN (SELECT {1} FROM {2} WHERE {3})'.format(
+        connection.ops.quote_name(queryset.model._meta.db_table),
+        _pk_sql(connection), index_table, match)
+    return queryset.extra(where=[where], params=params)
@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from . import search
+from .models import BugRelease, Note, Release, RenderedRelease, Tombstone
+from .utils import bump_last_modified_date, invalidate_release_json
+
+
+def releases_changed(release_ids, raw=False, modified=None,
+                     using=DEFAULT_DB_ALIAS):
+    """
+    Update data derived from the given releases, and from the releases
+    whose notes were fixed in them. Raw saves, such as loading fixtures or
+    syncing, and deletes only invalidate it, as related rows may be missing.
+    If the releases' or their notes' modified date was set, pass it to
+    keep the last modified date current. The bug index only depends on the
+    releases' own rows and note links, so it is always refreshed.
+    """
+    if modified:
+        bump_last_modified_date(modified, using=using)
+    release_ids = set(release_ids)
+    BugRelease.objects.db_manager(using).refresh(release_ids)
+    release_ids.update(Release.objects.using(using).filter(
+        note__fixed_in_release__in=release_ids).values_list('pk', flat=True))
+    if raw:
+        RenderedRelease.objects.using(using).filter(
+            release__in=release_ids).delete()
+    else:
+        RenderedRelease.objects.db_manager(using).refresh(release_ids)
+    invalidate_release_json(release_ids)
+
+
+def notes_changed(note_ids, raw=False, modified=None, using=DEFAULT_DB_ALIAS):
+    """Update data derived from the releases of the given notes"""
+    releases_changed(Release.objects.using(using).filter(
+        note__in=note_ids).values_list('pk', flat=True),
+        raw=raw, modified=modified, using=using)
+
+
+@receiver(post_save, sender=Release)
+def release_saved(sender, instance, raw, using, **kwargs):
+    releases_changed([instance.pk], raw=raw, modified=instance.modified,
+                     using=using)
+    search.update_index(Release, [instance.pk], using=using)
+
+
+@receiver(post_save, sender=Note)
+def note_saved(sender, instance, raw, using, **kwargs):
+    notes_changed([instance.pk], raw=raw, modified=instance.modified,
+                  using=using)
+    search.update_index(Note, [instance.pk], using=using)
+
+
+@receiver(pre_delete, sender=Note)
+def note_deleting(sender, instance, using, **kwargs):
+    instance._deleted_from_release_ids = list(
+        instance.releases.db_manager(using).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Note)
+def note_deleted(sender, instance, using, **kwargs):
+    releases_changed(instance._deleted_from_release_ids, raw=True, using=using)
+
+
+_tombstones = threading.local()
+
+
+@contextmanager
+def without_tombstones():
+    """
+    Delete releases and notes in the block without recording tombstones,
+    for deletes that come from upstream through rna.sync
+    """
+    _tombstones.disabled = True
+    try:
+        yield
+    finally:
+        _tombstones.disabled = False
+
+
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=Release)
+def record_tombstone(sender, instance, using, **kwargs):
+    if getattr(_tombstones, 'disabled', False):
+        modified = now()
+    else:
+        modified = Tombstone.objects.using(using).create(
+            model_label='{}.{}'.format(sender._meta.app_label,
+                                       sender._meta.model_name),
+            object_id=instance.pk).modified
+    # so that conditional requests for the sync feed see the delete
+    bump_last_modified_date(modified, using=using)
+    search.update_index(sender, [instance.pk], using=using)
+
+
+@receiver(m2m_changed, sender=Note.releases.through)
+def note_releases_changed(sender, instance, action, reverse, pk_set, using,
+                          **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance._cleared_note_ids = list(
+                instance.note_set.db_manager(using).values_list(
+                    'pk', flat=True))
+        else:
+            instance._cleared_release_ids = list(
+                instance.releases.db_manager(using).values_list(
+                    'pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            pk_set = (instance._cleared_note_ids if reverse
+                      else instance._cleared_release_ids)
+        if not pk_set:
+            return
+        if reverse:
+            release_ids, note_ids = [instance.pk], pk_set
+        else:
+            release_ids, note_ids = pk_set, [instance.pk]
+        # so that the sync feed and the notes' validators see the change
+        modified = now()
+        Note.objects.using(using).filter(pk__in=note_ids).update(
+            modified=modified)
+        releases_changed(release_ids, modified=modified, using=using)
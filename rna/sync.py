@@ -0,0 +1,377 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A delta feed of changed releases and notes, and the client that applies it.
+
+The feed lists Releases, Notes (with their release ids) and Tombstones of
+deleted objects in (modified, model, pk) order, so an opaque cursor naming
+the last position read is enough to resume from. Tombstones are pruned
+after RNA_TOMBSTONE_RETENTION days by rnarebuild, so a client further
+behind than that should sync with --clean.
+
+The client also applies the full dump served by the synctool route. Both
+are fetched with a pooled session that accepts gzip, retries transient
+failures and makes the first request of each sync conditional on the
+validators of the last one.
+"""
+
+import base64
+import datetime
+import json
+from collections import OrderedDict
+from itertools import chain
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from django.core import serializers
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, Q, Value, When
+from django.utils.dateparse import parse_datetime
+
+from . import search
+from .models import (BugRelease, Note, Release, RenderedRelease, SyncState,
+                     Tombstone)
+from .signals import releases_changed, without_tombstones
+from .utils import bump_last_modified_date, invalidate_release_json
+
+
+FEED_MODELS = (Release, Note, Tombstone)
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+TIMEOUT = 60
+
+
+def encode_cursor(modified, rank, pk):
+    return base64.urlsafe_b64encode(
+        '{}|{}|{}'.format(modified.isoformat(), rank, pk))
+
+
+def decode_cursor(cursor):
+    """Return (modified, rank, pk) for a cursor, or raise ValueError"""
+    try:
+        modified, rank, pk = base64.urlsafe_b64decode(str(cursor)).split('|')
+        modified = parse_datetime(modified)
+        rank = int(rank)
+        pk = int(pk)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: {!r}'.format(cursor))
+    if modified is None or not 0 <= rank < len(FEED_MODELS):
+        raise ValueError('Invalid cursor: {!r}'.format(cursor))
+    return modified, rank, pk
+
+
+def after(queryset, rank, position):
+    """Filter a feed model's queryset to rows after a cursor position"""
+    if position is None:
+        return queryset
+    modified, last_rank, last_pk = position
+    if rank < last_rank:
+        return queryset.filter(modified__gt=modified)
+    if rank > last_rank:
+        return queryset.filter(modified__gte=modified)
+    return queryset.filter(
+        Q(modified__gt=modified) | Q(modified=modified, pk__gt=last_pk))
+
+
+def serialize_changes(objects):
+    """Return feed records for Release, Note and Tombstone instances"""
+    note_ids = [obj.pk for obj in objects if isinstance(obj, Note)]
+    note_releases = dict((pk, []) for pk in note_ids)
+    for note_id, release_id in Note.releases.through.objects.filter(
+            note__in=note_ids).values_list('note', 'release'):
+        note_releases[note_id].append(release_id)
+
+    records = []
+    for obj in objects:
+        if isinstance(obj, Tombstone):
+            records.append({'model': obj.model_label, 'pk': obj.object_id,
+                            'deleted': True})
+            continue
+        record = serializers.serialize('python', [obj], fields=[
+            f.name for f in obj._meta.fields if not f.primary_key])[0]
+        if isinstance(obj, Note):
+            record['fields']['releases'] = sorted(note_releases[obj.pk])
+        records.append(record)
+    return records
+
+
+def get_changes(cursor=None, limit=PAGE_SIZE):
+    """
+    Return a page of at most limit changes after cursor as a dict with the
+    changes, the cursor to continue from and whether there are more. Releases
+    referenced by the page's notes that would only appear in a later page are
+    included first so that every page can be applied on its own.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    rows = []
+    for rank, model in enumerate(FEED_MODELS):
+        queryset = after(model.objects.order_by('modified', 'pk'), rank, position)
+        # one more than needed, to tell whether there are more
+        rows.extend((obj.modified, rank, obj.pk, obj) for obj in queryset[:limit + 1])
+    rows.sort(key=lambda row: row[:3])
+    page = rows[:limit]
+    if page:
+        modified, rank, pk = page[-1][:3]
+        cursor = encode_cursor(modified, rank, pk)
+        position = (modified, rank, pk)
+
+    objects = [row[3] for row in page]
+    referenced = set()
+    for obj in objects:
+        if isinstance(obj, Note):
+            referenced.add(obj.fixed_in_release_id)
+    referenced.update(Note.releases.through.objects.filter(
+        note__in=[obj for obj in objects if isinstance(obj, Note)]).values_list(
+            'release', flat=True))
+    referenced.discard(None)
+    if referenced:
+        rank = FEED_MODELS.index(Release)
+        objects[:0] = after(Release.objects.filter(pk__in=referenced).order_by(),
+                            rank, position)
+
+    return {
+        'cursor': cursor,
+        'more': len(rows) > len(page),
+        'changes': serialize_changes(objects),
+    }
+
+
+class FeedJSONEncoder(DjangoJSONEncoder):
+    """Keeps the microseconds that DjangoJSONEncoder drops"""
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super(FeedJSONEncoder, self).default(o)
+
+
+def encode_changes(changes):
+    return json.dumps(changes, cls=FeedJSONEncoder)
+
+
+def bulk_update(model, objs, using):
+    """
+    Update the non-pk fields of existing rows from objs, with one UPDATE
+    of CASE expressions per batch
+    """
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    batch_size = max(1, connections[using].ops.bulk_batch_size(
+        [None] * (2 * len(fields) + 1), objs))
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        model._base_manager.using(using).filter(
+            pk__in=[obj.pk for obj in batch]).update(**dict(
+                (field.name, Case(*[
+                    When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                               output_field=field))
+                    for obj in batch], output_field=field))
+                for field in fields))
+
+
+def bulk_upsert(model, objs, using):
+    """
+    Insert objs, or update their rows if their modified date differs, with
+    bulk queries. Return the objs written.
+    """
+    existing = dict(model._base_manager.using(using).filter(
+        pk__in=[obj.pk for obj in objs]).values_list('pk', 'modified'))
+    changed = [obj for obj in objs if existing.get(obj.pk) != obj.modified]
+    model._base_manager.using(using).bulk_create(
+        [obj for obj in changed if obj.pk not in existing])
+    bulk_update(model, [obj for obj in changed if obj.pk in existing], using)
+    return changed
+
+
+def apply_changes(records, using=DEFAULT_DB_ALIAS):
+    """
+    Save or delete the objects in a page of feed records with bulk queries,
+    and invalidate what is derived from them. Objects whose modified date
+    is unchanged are skipped, so applying a whole dump only invalidates what
+    changed. Return the number of rows written.
+    """
+    saved = OrderedDict((model, OrderedDict()) for model in (Release, Note))
+    deleted = OrderedDict((model, set()) for model in (Note, Release))
+    note_releases = {}
+    for record in records:
+        model = Release if record['model'] == 'rna.release' else Note
+        if record.get('deleted'):
+            saved[model].pop(record['pk'], None)
+            if model is Note:
+                note_releases.pop(record['pk'], None)
+            deleted[model].add(record['pk'])
+            continue
+        obj = next(serializers.deserialize('python', [record], using=using))
+        if model is Release:
+            obj.object.set_stored_fields()
+        saved[model][obj.object.pk] = obj.object
+        deleted[model].discard(obj.object.pk)
+        if model is Note:
+            note_releases[obj.object.pk] = obj.m2m_data.get('releases', [])
+
+    for model, objs in saved.items():
+        saved[model] = OrderedDict(
+            (obj.pk, obj) for obj in bulk_upsert(model, objs.values(), using))
+    # a note's modified date moves when its releases change
+    note_releases = dict((pk, note_releases[pk]) for pk in saved[Note])
+
+    through = Note.releases.through
+    links = through.objects.using(using).filter(note__in=list(note_releases))
+    # the releases the notes are removed from change too
+    changed_ids = set(links.values_list('release', flat=True))
+    links.delete()
+    through.objects.using(using).bulk_create([
+        through(note_id=note_id, release_id=release_id)
+        for note_id, release_ids in note_releases.items()
+        for release_id in release_ids])
+
+    # the upstream tombstones are in the feed already
+    with without_tombstones():
+        for model, pks in deleted.items():
+            if pks:
+                model.objects.using(using).filter(pk__in=pks).delete()
+
+    changed_ids.update(saved[Release])
+    changed_ids.update(through.objects.using(using).filter(
+        note__in=list(saved[Note])).values_list('release', flat=True))
+    modified = [o.modified for objs in saved.values() for o in objs.values()]
+    releases_changed(changed_ids, raw=True, modified=max(modified or [None]),
+                     using=using)
+    for model, objs in saved.items():
+        search.update_index(model, objs, using=using)
+
+    return sum(len(rows) for rows in chain(
+        saved.values(), note_releases.values(), deleted.values()))
+
+
+def delete_all(using=DEFAULT_DB_ALIAS):
+    """
+    Delete every release and note, and the data derived from them, with a
+    statement per table rather than the signal handlers of every row. The
+    deletes come from upstream, so no tombstones are recorded.
+    """
+    release_ids = list(Release.objects.using(using).values_list(
+        'pk', flat=True))
+    for model in (RenderedRelease, BugRelease, Note.releases.through, Note,
+                  Release):
+        model.objects.using(using).all()._raw_delete(using)
+    search.clear_index(using)
+    invalidate_release_json(release_ids)
+    bump_last_modified_date(using=using)
+
+
+def reset_sequences(using=DEFAULT_DB_ALIAS):
+    """Move the pk sequences past the rows inserted with their upstream pks"""
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(
+        no_style(), [Release, Note, Note.releases.through])
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def get_session(retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """
+    Return a session that keeps connections alive between requests, asks
+    for gzip and retries connection errors and 5xx responses with backoff
+    """
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip'
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(session, url, params=None, state=None):
+    """
+    GET url, conditionally on the validators stored in state if given.
+    Return the response, or None if it was not modified.
+    """
+    headers = {}
+    if state is not None:
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified:
+            headers['If-Modified-Since'] = state.last_modified
+    response = session.get(url, params=params, headers=headers,
+                           timeout=TIMEOUT)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return response
+
+
+def save_validators(state, response):
+    state.etag = response.headers.get('ETag', '')
+    state.last_modified = response.headers.get('Last-Modified', '')
+
+
+def sync_feed(url, clean=False, using=DEFAULT_DB_ALIAS, session=None):
+    """
+    Apply pages of changes from the feed at url, starting after the cursor
+    stored for url and storing the new one with each page, so an
+    interrupted sync resumes where it stopped. Return the number of
+    rows written.
+    """
+    session = session or get_session()
+    state, created = SyncState.objects.using(using).get_or_create(url=url)
+    if clean:
+        with transaction.atomic(using=using):
+            delete_all(using)
+            state.cursor = state.etag = state.last_modified = ''
+            state.save(using=using)
+
+    count = 0
+    # only the first page can be unchanged since the last sync
+    conditional = state
+    while True:
+        params = {'cursor': state.cursor} if state.cursor else {}
+        response = fetch(session, url, params, conditional)
+        if response is None:
+            break
+        page = response.json()
+        with transaction.atomic(using=using):
+            count += apply_changes(page['changes'], using=using)
+            if page['cursor']:
+                state.cursor = page['cursor']
+            if page['more']:
+                state.etag = state.last_modified = ''
+            else:
+                save_validators(state, response)
+            state.save(using=using)
+        conditional = None
+        if not page['more']:
+            break
+    if count:
+        reset_sequences(using)
+    return count
+
+
+def sync_dump(url, clean=False, using=DEFAULT_DB_ALIAS, session=None):
+    """
+    Apply the full dump of releases and notes at url, unless it is unchanged
+    since the last sync. Return the number of rows written.
+    """
+    session = session or get_session()
+    state, created = SyncState.objects.using(using).get_or_create(url=url)
+    response = fetch(session, url, state=None if clean else state)
+    if response is None:
+        return 0
+
+    with transaction.atomic(using=using):
+        if clean:
+            delete_all(using)
+        count = apply_changes(response.json(), using=using)
+        save_validators(state, response)
+        state.save(using=using)
+    reset_sequences(using)
+    return count
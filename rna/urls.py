@@ -14,8 +14,14 @@ router.register('releases', views.ReleaseViewSet)
 
 urlpatterns = [
     url(r'^', include(router.urls)),
-    url(r'^releases/(?P<pk>\d+)/notes/$', views.NestedNoteView.as_view()),
+    url(r'^releases/(?P<key>[^/]+)/notes/$', views.NestedNoteView.as_view()),
+    url(r'^releases/(?P<key>[^/]+)/json/$', views.release_json),
+    url(r'^releases/(?P<key>[^/]+)/diff/(?P<other_key>[^/]+)/$',
+        views.release_diff),
+    url(r'^bugs/(?P<bug>\d+)/releases/$', views.BugReleaseView.as_view()),
     url(r'^auth_token/$', views.auth_token),
     url(r'^sync/?$', views.rnasync),
+    url(r'^sync/changes/$', views.sync_changes),
     url(r'^all-releases\.json$', views.export_json),
+    url(r'^all-releases\.ndjson$', views.export_ndjson),
 ]
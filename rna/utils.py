@@ -1,16 +1,33 @@
+import gzip
 import json
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.encoding import force_bytes
+from django.utils.timezone import now
 
-from .models import Note, Release
+from .models import Note, Release, RenderedRelease, Watermark
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def get_last_modified_date(*args, **kwargs):
-    """Returns the date of the last modified Note or Release.
 
-    For use with Django's last_modified decorator.
-    """
+LAST_MODIFIED_CACHE_KEY = 'rna:last_modified'
+# per-process copy of the cached date, see RNA_LAST_MODIFIED_TTL
+_last_modified = {}
+
+
+def compute_last_modified_date():
+    """Returns the date of the last modified Note or Release."""
     try:
         latest_note = Note.objects.latest()
         latest_release = Release.objects.latest()
@@ -20,15 +37,194 @@ def get_last_modified_date(*args, **kwargs):
     return max(latest_note.modified, latest_release.modified)
 
 
+def get_last_modified_date(*args, **kwargs):
+    """Returns the date of the last modified Note or Release.
+
+    The date is stored in the Watermark row, kept current by
+    bump_last_modified_date. It is cached for RNA_LAST_MODIFIED_CACHE_TIME
+    seconds, and held in memory for RNA_LAST_MODIFIED_TTL seconds if that
+    is set.
+
+    For use with Django's last_modified decorator.
+    """
+    ttl = getattr(settings, 'RNA_LAST_MODIFIED_TTL', 0)
+    if ttl and _last_modified.get('expires', 0) > time.time():
+        return _last_modified['date']
+
+    date = cache.get(LAST_MODIFIED_CACHE_KEY)
+    if date is None:
+        date = Watermark.objects.values_list('modified', flat=True).first()
+        if date is None:
+            date = compute_last_modified_date()
+            if date is not None:
+                bump_last_modified_date(date)
+        if date is not None:
+            cache.set(LAST_MODIFIED_CACHE_KEY, date, getattr(
+                settings, 'RNA_LAST_MODIFIED_CACHE_TIME', 60))
+    if ttl:
+        _last_modified.update(date=date, expires=time.time() + ttl)
+    return date
+
+
+def bump_last_modified_date(date=None, using=DEFAULT_DB_ALIAS):
+    """Move the stored last modified date forward to date, or now."""
+    date = date or now()
+    watermarks = Watermark.objects.using(using)
+    if not watermarks.filter(modified__lt=date).update(modified=date):
+        watermarks.get_or_create(pk=1, defaults={'modified': date})
+    cache.delete(LAST_MODIFIED_CACHE_KEY)
+    _last_modified.clear()
+
+
+def reset_last_modified_date():
+    """Recompute the stored last modified date from the database."""
+    Watermark.objects.all().delete()
+    cache.delete(LAST_MODIFIED_CACHE_KEY)
+    _last_modified.clear()
+    return get_last_modified_date()
+
+
+EXPORT_CACHE_KEY = 'rna:export:{}:{}'
+# file extensions of the compressed export artifacts
+ENCODING_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+RELEASE_JSON_VERSION_KEY = 'rna:release_json_version:{}'
+RELEASE_JSON_KEY = 'rna:release_json:{}:{}'
+
+
+def get_release_json(pk):
+    """Returns (version, JSON) of a release, or None if there is none.
+
+    The version is the release's effective modified date, the latest of its
+    own and its notes'. The JSON is cached under it, and the current version
+    is cached until invalidate_release_json is called for the release.
+    """
+    version_key = RELEASE_JSON_VERSION_KEY.format(pk)
+    version = cache.get(version_key)
+    if version is not None:
+        data = cache.get(RELEASE_JSON_KEY.format(pk, version))
+        if data is not None:
+            return version, data
+
+    rendered = RenderedRelease.objects.filter(release=pk).first()
+    if rendered is None:
+        if not RenderedRelease.objects.refresh([pk]):
+            return None
+        rendered = RenderedRelease.objects.get(release=pk)
+    version = rendered.source_modified.isoformat()
+    timeout = getattr(settings, 'RNA_JSON_CACHE_TIME', 600)
+    cache.set_many({
+        version_key: version,
+        RELEASE_JSON_KEY.format(pk, version): rendered.data,
+    }, timeout)
+    return version, rendered.data
+
+
+def invalidate_release_json(release_ids):
+    """Drops the cached JSON of the given releases.
+
+    The JSON is dropped along with the version, as removing a note from a
+    release changes it without changing the effective modified date.
+    """
+    version_keys = dict((RELEASE_JSON_VERSION_KEY.format(pk), pk)
+                        for pk in release_ids)
+    versions = cache.get_many(version_keys.keys())
+    cache.delete_many(list(version_keys) + [
+        RELEASE_JSON_KEY.format(version_keys[key], version)
+        for key, version in versions.items()])
+
+
+def get_encodings():
+    """Returns the available Content-Encodings, most preferred first."""
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def compress(data, encoding):
+    """Returns the bytes data in the given Content-Encoding.
+
+    Brotli uses RNA_BROTLI_QUALITY, as its default of 11 is too slow to
+    compress the export on a request.
+    """
+    if encoding == 'gzip':
+        buf = BytesIO()
+        # no timestamp, so that the same data compresses the same
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fp:
+            fp.write(data)
+        return buf.getvalue()
+    if encoding == 'br':
+        return brotli.compress(
+            data, quality=getattr(settings, 'RNA_BROTLI_QUALITY', 5))
+    return data
+
+
+def iter_gzip(chunks, chunk_size=64 * 1024):
+    """Yields the gzip compression of an iterable of strings.
+
+    Output is yielded in pieces of about chunk_size bytes, so that neither
+    the input nor the output is ever in memory as a whole.
+    """
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fp:
+        for chunk in chunks:
+            fp.write(force_bytes(chunk))
+            if buf.tell() >= chunk_size:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    yield buf.getvalue()
+
+
+def choose_encoding(accept_encoding, encodings=None):
+    """Returns the preferred available encoding in an Accept-Encoding header.
+
+    Only the given encodings are considered, if any are given. Returns
+    'identity' if none is accepted.
+    """
+    accepted = set()
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted.add(params[0].strip().lower())
+    for encoding in encodings or get_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return 'identity'
+
+
+def get_export_artifact(encoding):
+    """Returns the JSON list of all releases in the given Content-Encoding.
+
+    It is built once per last modified date and encoding, and cached for
+    RNA_JSON_CACHE_TIME seconds.
+    """
+    modified = get_last_modified_date()
+    key = EXPORT_CACHE_KEY.format(modified.isoformat() if modified else '',
+                                  encoding)
+    data = cache.get(key)
+    if data is None:
+        with record_timing('serialize'):
+            releases = list(RenderedRelease.objects.iter_json())
+        with record_timing('encode'):
+            data = ''.join(iter_json_list(releases, encoded=True))
+            data = compress(data.encode('utf-8'), encoding)
+        cache.set(key, data, getattr(settings, 'RNA_JSON_CACHE_TIME', 600))
+    return data
+
+
 def migrate_versions():
-    for r in Release.objects.filter(version__endswith='.0.0').only(
-            'channel', 'version'):
-        if r.channel == 'Release':
-            Release.objects.filter(id=r.id).update(version=r.version[:-2])
-        elif r.channel == 'Aurora':
-            Release.objects.filter(id=r.id).update(version=r.version[:-2] + 'a2')
-        elif r.channel == 'Beta':
-            Release.objects.filter(id=r.id).update(version=r.version[:-2] + 'beta')
+    """Drops the .0.0 of versions, saving so that derived data follows."""
+    suffixes = {'Release': '', 'Aurora': 'a2', 'Beta': 'beta'}
+    for r in Release.objects.filter(version__endswith='.0.0',
+                                    channel__in=suffixes):
+        r.version = r.version[:-2] + suffixes[r.channel]
+        r.save()
 
 
 def get_duplicate_product_versions():
@@ -45,6 +241,44 @@ def get_duplicate_product_versions():
     return duplicates
 
 
+class Timer(object):
+    """Context manager recording the elapsed wall clock time in seconds"""
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+
+
+# durations recorded by record_timing for the current request, see
+# rna.middleware.ServerTimingMiddleware
+_timings = threading.local()
+
+
+def start_timings():
+    _timings.durations = {}
+
+
+def stop_timings():
+    """Returns the durations recorded since start_timings and stops."""
+    durations = getattr(_timings, 'durations', None) or {}
+    _timings.durations = None
+    return durations
+
+
+@contextmanager
+def record_timing(name):
+    """Adds the time spent in the block to the named duration, if recording."""
+    durations = getattr(_timings, 'durations', None)
+    if durations is None:
+        yield
+        return
+    with Timer() as timer:
+        yield
+    durations[name] = durations.get(name, 0) + timer.elapsed
+
+
 class HttpResponseJSON(HttpResponse):
     def __init__(self, data, status=None, cors=False):
         super(HttpResponseJSON, self).__init__(content=json.dumps(data),
@@ -53,3 +287,36 @@ class HttpResponseJSON(HttpResponse):
 
         if cors:
             self['Access-Control-Allow-Origin'] = '*'
+
+
+def iter_json_list(items, encoded=False):
+    """
+    Yield the same output as json.dumps(list(items)), one item at a time.
+    If encoded is True the items are already JSON encoded.
+    """
+    yield '['
+    for i, item in enumerate(items):
+        if i:
+            yield ', '
+        yield item if encoded else json.dumps(item)
+    yield ']'
+
+
+def iter_ndjson(items, encoded=False):
+    """
+    Yield newline-delimited JSON, one item per line. If encoded is True the
+    items are already JSON encoded, without newlines.
+    """
+    for item in items:
+        yield (item if encoded else json.dumps(item)) + '\n'
+
+
+class StreamingHttpResponseJSON(StreamingHttpResponse):
+    def __init__(self, items, status=None, cors=False, encoded=False):
+        super(StreamingHttpResponseJSON, self).__init__(
+            streaming_content=iter_json_list(items, encoded=encoded),
+            content_type='application/json',
+            status=status)
+
+        if cors:
+            self['Access-Control-Allow-Origin'] = '*'
@@ -2,25 +2,76 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 import json
+from calendar import timegm
+from collections import OrderedDict
 
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseForbidden
+from django.db.models import Count, Max
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
-from django.views.decorators.http import last_modified, require_safe
-from django.views.decorators.cache import cache_page
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import force_bytes
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
+from django.views.decorators.http import condition, require_safe
+from django.views.decorators.gzip import gzip_page
 
-from rest_framework import generics
+from rest_framework import generics, status
 from rest_framework.authtoken.models import Token
+from rest_framework.decorators import list_route
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 from synctool.routing import Route
 
-from . import models, serializers
-from .utils import get_last_modified_date, HttpResponseJSON
+from . import models, search, serializers, sync
+from .pagination import KeysetPagination
+from .utils import (choose_encoding, get_export_artifact,
+                    get_last_modified_date, get_release_json, iter_gzip,
+                    iter_ndjson, record_timing, StreamingHttpResponseJSON)
+
+
+rnasync_route = Route(api_token=None)
+
+
+# only the source data, not what is derived from it
+@rnasync_route.queryset('rna')
+def rnasync():
+    return [models.Release.objects.all(), models.Note.objects.all()]
+
+
+def sync_etag(request, *args, **kwargs):
+    """The last modified date to the microsecond, and the query"""
+    modified = get_last_modified_date()
+    if modified:
+        return hashlib.md5('{}?{}'.format(
+            modified.isoformat(), request.GET.urlencode())).hexdigest()
+
+
+sync_condition = condition(etag_func=sync_etag,
+                           last_modified_func=get_last_modified_date)
+rnasync = sync_condition(gzip_page(rnasync))
+
+
+@require_safe
+@sync_condition
+@gzip_page
+def sync_changes(request):
+    try:
+        limit = int(request.GET.get('limit', sync.PAGE_SIZE))
+        limit = max(1, min(limit, sync.MAX_PAGE_SIZE))
+        with record_timing('serialize'):
+            changes = sync.get_changes(request.GET.get('cursor'), limit)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    with record_timing('encode'):
+        content = sync.encode_changes(changes)
+    return HttpResponse(content=content, content_type='application/json')
 
 
-rnasync = Route(api_token=None).app('rna', 'rna')
-rnasync = last_modified(get_last_modified_date)(rnasync)
 RNA_JSON_CACHE_TIME = getattr(settings, 'RNA_JSON_CACHE_TIME', 600)
 
 
@@ -34,26 +85,206 @@ def auth_token(request):
         return HttpResponseForbidden()
 
 
-class NoteViewSet(ModelViewSet):
+class ConditionalResponseMixin(object):
+    """
+    Adds an ETag and Last-Modified to retrieve and list responses and
+    answers 304 Not Modified when the client's copy is current, before
+    anything is serialized. Detail ETags come from the object's id and
+    modified date, which moves when a note's releases change, list ETags
+    from the query and the count and latest modified date of the filtered
+    queryset. Both include the negotiated media type.
+    """
+    def not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            try:
+                return etag in parse_etags(if_none_match)
+            except ValueError:
+                return False
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        if if_modified_since and last_modified:
+            return timegm(last_modified.utctimetuple()) <= if_modified_since
+        return False
+
+    def conditional_response(self, request, key, last_modified, get_data):
+        etag = hashlib.md5(force_bytes('{}|{}'.format(
+            request.accepted_renderer.media_type, key))).hexdigest()
+        if self.not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            with record_timing('serialize'):
+                response = get_data()
+        response['ETag'] = quote_etag(etag)
+        patch_vary_headers(response, ['Accept'])
+        if last_modified:
+            response['Last-Modified'] = http_date(
+                timegm(last_modified.utctimetuple()))
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return self.conditional_response(
+            request, '{}|{}'.format(instance.pk, instance.modified.isoformat()),
+            instance.modified,
+            lambda: Response(self.get_serializer(instance).data))
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        stats = queryset.order_by().aggregate(Max('modified'), Count('pk'))
+        last_modified = stats['modified__max']
+        return self.conditional_response(
+            request, '{}|{}|{}'.format(
+                request.get_full_path(),
+                last_modified.isoformat() if last_modified else '',
+                stats['pk__count']),
+            last_modified,
+            lambda: super(ConditionalResponseMixin, self).list(
+                request, *args, **kwargs))
+
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+class NoteViewSet(ConditionalResponseMixin, ModelViewSet):
     queryset = models.Note.objects.all()
     serializer_class = serializers.NoteSerializer
+    pagination_class = KeysetPagination
+
+    @list_route()
+    def search(self, request):
+        """
+        Notes matching every word of q, best first, with their bug, a
+        snippet of the note and the slugs of their releases
+        """
+        try:
+            limit = int(request.query_params.get('limit', SEARCH_LIMIT))
+        except ValueError:
+            return Response({'detail': 'Invalid limit'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+        with record_timing('serialize'):
+            results = search.search(
+                models.Note, request.query_params.get('q', ''), limit)
+            bugs = dict(models.Note.objects.filter(
+                pk__in=[pk for pk, rank, snippet in results]).values_list(
+                    'pk', 'bug'))
+            slugs = dict((pk, []) for pk in bugs)
+            for note_id, slug in models.Note.releases.through.objects.filter(
+                    note__in=list(bugs)).values_list('note', 'release__slug'):
+                slugs[note_id].append(slug)
+        return Response([OrderedDict([
+            ('id', pk),
+            ('bug', bugs[pk]),
+            ('snippet', snippet),
+            ('rank', rank),
+            ('releases', sorted(slugs[pk])),
+        ]) for pk, rank, snippet in results if pk in bugs])
 
 
-class ReleaseViewSet(ModelViewSet):
+def get_release_or_404(queryset, key):
+    """Return the release of queryset with the id or slug key"""
+    if key.isdigit():
+        return get_object_or_404(queryset, pk=key)
+    release = models.Release.objects.get_by_slug(key, queryset)
+    if release is None:
+        raise Http404
+    return release
+
+
+class ReleaseViewSet(ConditionalResponseMixin, ModelViewSet):
     queryset = models.Release.objects.all()
     serializer_class = serializers.ReleaseSerializer
+    pagination_class = KeysetPagination
+    # slugs have dots in their version
+    lookup_value_regex = '[^/]+'
+
+    def get_object(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        obj = get_release_or_404(queryset, self.kwargs['pk'])
+        self.check_object_permissions(self.request, obj)
+        return obj
 
 
-class NestedNoteView(generics.ListAPIView):
+class NestedNoteView(ConditionalResponseMixin, generics.ListAPIView):
     model = models.Note
     serializer_class = serializers.NoteSerializer
 
     def get_queryset(self):
-        release = get_object_or_404(models.Release, pk=self.kwargs.get('pk'))
+        release = get_release_or_404(models.Release.objects.all(),
+                                     self.kwargs['key'])
         return release.note_set.all()
 
 
-@cache_page(RNA_JSON_CACHE_TIME)
+class BugReleaseView(ConditionalResponseMixin, generics.ListAPIView):
+    """The releases that fixed a bug, from the bug index"""
+    serializer_class = serializers.ReleaseSerializer
+
+    def get_queryset(self):
+        bug = int(self.kwargs['bug'])
+        if bug > models.MAX_BUG:
+            # past the integer column, so no release fixed it
+            return models.Release.objects.none()
+        return models.Release.objects.filter(bugs__bug=bug)
+
+
 @require_safe
+def release_json(request, key):
+    """The JSON of one release as in the export, by id or slug"""
+    if key.isdigit():
+        pk = int(key)
+    else:
+        pk = get_release_or_404(models.Release.objects.only('pk'), key).pk
+    rendered = get_release_json(pk)
+    if rendered is None:
+        raise Http404
+    version, data = rendered
+    response = HttpResponse(content=data, content_type='application/json')
+    response['ETag'] = quote_etag('{}-{}'.format(pk, version))
+    return response
+
+
+@require_safe
+def release_diff(request, key, other_key):
+    """What changed between two releases, by id or slug"""
+    release = get_release_or_404(models.Release.objects.all(), key)
+    other = get_release_or_404(models.Release.objects.all(), other_key)
+    return HttpResponse(content=json.dumps(release.diff(other)),
+                        content_type='application/json')
+
+
+@require_safe
+@condition(last_modified_func=get_last_modified_date)
 def export_json(request):
-    return HttpResponseJSON(models.Release.objects.all_as_list())
+    """
+    All releases as a JSON list, gzip or brotli encoded if the client
+    accepts it, from artifacts built once per change. With
+    RNA_JSON_STREAMING, it is streamed instead, gzip encoded as it goes
+    if the client accepts it.
+    """
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if getattr(settings, 'RNA_JSON_STREAMING', False):
+        encoding = choose_encoding(accept_encoding, ['gzip'])
+        response = StreamingHttpResponseJSON(
+            models.RenderedRelease.objects.iter_json(), encoded=True)
+        if encoding == 'gzip':
+            response.streaming_content = iter_gzip(response.streaming_content)
+    else:
+        encoding = choose_encoding(accept_encoding)
+        response = HttpResponse(content=get_export_artifact(encoding),
+                                content_type='application/json')
+    if encoding != 'identity':
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_cache_control(response, max_age=RNA_JSON_CACHE_TIME)
+    return response
+
+
+@require_safe
+@condition(last_modified_func=get_last_modified_date)
+def export_ndjson(request):
+    """All releases as newline-delimited JSON, streamed a chunk at a time"""
+    return StreamingHttpResponse(
+        iter_ndjson(models.RenderedRelease.objects.iter_json(), encoded=True),
+        content_type='application/x-ndjson')
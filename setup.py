@@ -14,7 +14,8 @@ setup(
     author_email='jmize@mozilla.com',
     url='https://github.com/mozilla/rna/',
     license='MPL 2.0',
-    packages=['rna', 'rna.management', 'rna.management.commands'],
+    packages=['rna', 'rna.management', 'rna.management.commands',
+              'rna.migrations'],
     include_package_data=True,
     zip_safe=False,
     install_requires=[
@@ -22,7 +23,12 @@ setup(
         'djangorestframework>=3.3.0',
         'django-extensions>=1.2.0',
         'django-synctool',
+        'requests',
     ],
+    extras_require={
+        # brotli encoded exports
+        'brotli': ['brotli'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
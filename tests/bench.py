@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmarks of the hot paths of rna against a seeded synthetic dataset.
+
+    ./tests/bench.py --releases 500 --notes 30 --output bench.json
+    ./tests/bench.py --output after.json --compare bench.json
+
+Results are written as JSON with the parameters and commit they were run
+with, so that runs can be compared between commits.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+def generate(releases=200, notes=20, fanout=2, known_issues=0.1, seed=0):
+    """
+    Create releases spread across Release.PRODUCTS and CHANNELS, each with
+    about `notes` notes. Each note belongs to `fanout` releases, and a
+    `known_issues` fraction of them are known issues, half of those fixed
+    in some release. The same arguments create the same dataset.
+    """
+    from rna.models import Note, Release, RenderedRelease
+    from rna.utils import reset_last_modified_date
+
+    rng = random.Random(seed)
+    suffixes = {'Nightly': 'a1', 'Aurora': 'a2', 'Beta': 'beta', 'ESR': 'esr'}
+    combos = [(p, c) for c in Release.CHANNELS for p in Release.PRODUCTS]
+    start = datetime(2010, 1, 1)
+    objs = []
+    for i in range(releases):
+        product, channel = combos[i % len(combos)]
+        major = i // len(combos) + 1
+        release = Release(
+            product=product, channel=channel,
+            version='{}.0{}'.format(major, suffixes.get(channel, '')),
+            release_date=start + timedelta(days=i),
+            is_public=rng.random() < 0.9,
+            text='Release text ' * rng.randint(1, 20),
+            modified=start + timedelta(days=i))
+        release.set_stored_fields()
+        objs.append(release)
+    Release.objects.bulk_create(objs)
+    release_ids = list(Release.objects.order_by('release_date').values_list(
+        'pk', flat=True))
+
+    objs = []
+    for i in range(releases * notes):
+        is_known_issue = rng.random() < known_issues
+        fixed_in_release_id = None
+        if is_known_issue and rng.random() < 0.5:
+            fixed_in_release_id = rng.choice(release_ids)
+        objs.append(Note(
+            bug=rng.randint(100000, 1300000),
+            note='Note {} '.format(i) * rng.randint(1, 10),
+            tag=rng.choice(Note.TAGS) if rng.random() < 0.8 else '',
+            sort_num=rng.randint(0, 5),
+            is_known_issue=is_known_issue,
+            fixed_in_release_id=fixed_in_release_id,
+            modified=start + timedelta(minutes=i)))
+    Note.objects.bulk_create(objs)
+
+    through = Note.releases.through
+    rows = []
+    for note_id in Note.objects.values_list('pk', flat=True):
+        for release_id in rng.sample(release_ids, min(fanout, len(release_ids))):
+            rows.append(through(note_id=note_id, release_id=release_id))
+    through.objects.bulk_create(rows, batch_size=500)
+
+    # bulk_create sends no signals
+    RenderedRelease.objects.refresh(release_ids)
+    reset_last_modified_date()
+
+
+def measure(func, repeat):
+    """Call func repeat times and return its timings and query count"""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    times = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'queries': len(queries),
+    }
+
+
+def get_benchmarks(sample_size=20, seed=0):
+    """Return a list of (name, function) to time"""
+    from django.core.cache import cache
+    from django.core.management import call_command
+    from django.test import Client
+    from django.test.utils import override_settings
+
+    from rna.models import Release
+    from rna.utils import get_last_modified_date
+
+    rng = random.Random(seed)
+    releases = list(Release.objects.all())
+    sample = rng.sample(releases, min(sample_size, len(releases)))
+    client = Client()
+
+    def all_as_list():
+        Release.objects.all_as_list()
+
+    def release_notes():
+        for release in sample:
+            release.notes()
+
+    def equivalent_release_for_product():
+        for release in sample:
+            release.equivalent_release_for_product('Firefox')
+
+    def export_json_command():
+        tmp_dir = mkdtemp()
+        try:
+            with override_settings(RNA_JSON_EXPORT_DIR=os.path.join(
+                    tmp_dir, 'json_export')):
+                with open(os.devnull, 'w') as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        call_command('export_json')
+                    finally:
+                        sys.stdout = stdout
+        finally:
+            rmtree(tmp_dir)
+
+    def get(path):
+        def request():
+            response = client.get(path)
+            assert response.status_code == 200, response.status_code
+        return request
+
+    def last_modified_uncached():
+        cache.clear()
+        get_last_modified_date()
+
+    return [
+        ('all_as_list', all_as_list),
+        ('release_notes', release_notes),
+        ('equivalent_release_for_product', equivalent_release_for_product),
+        ('export_json_command', export_json_command),
+        ('rest_release_list', get('/releases/')),
+        ('rest_note_list', get('/notes/')),
+        ('get_last_modified_date', get_last_modified_date),
+        ('get_last_modified_date_uncached', last_modified_uncached),
+    ]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print the median of each benchmark relative to a previous run"""
+    for name, result in sorted(results.items()):
+        if name in previous:
+            print('{:35} {:8.2f}x'.format(
+                name, result['median'] / max(previous[name]['median'], 1e-9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--releases', type=int, default=200)
+    parser.add_argument('--notes', type=int, default=20,
+                        help='Notes per release.')
+    parser.add_argument('--fanout', type=int, default=2,
+                        help='Releases per note.')
+    parser.add_argument('--known-issues', type=float, default=0.1,
+                        help='Fraction of notes that are known issues.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append',
+                        help='Only run the named benchmark. Repeatable.')
+    parser.add_argument('--output', help='File to write the results to.')
+    parser.add_argument('--compare', help='Results of a previous run.')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+    # keeping every query in connection.queries would skew the timings
+    settings.DEBUG = False
+
+    params = dict((k, getattr(args, k)) for k in (
+        'releases', 'notes', 'fanout', 'known_issues', 'seed', 'repeat'))
+    start = time.time()
+    generate(args.releases, args.notes, args.fanout, args.known_issues,
+             args.seed)
+    print('Generated dataset in {:.2f}s'.format(time.time() - start))
+
+    results = {}
+    for name, func in get_benchmarks(seed=args.seed):
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(func, args.repeat)
+        print('{:35} {median:8.4f}s median {min:8.4f}s min {queries:6} '
+              'queries'.format(name, **results[name]))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'commit': get_commit(),
+                'date': datetime.utcnow().isoformat(),
+                'params': params,
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp)['results'])
+
+
+if __name__ == '__main__':
+    main()
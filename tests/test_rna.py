@@ -2,29 +2,50 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from datetime import datetime
+import gzip
+import json
+import os
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
 
-from django.core.management import call_command
-from django.test import TestCase
-from django.test.utils import override_settings
-from mock import Mock, patch
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connections, IntegrityError
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from mock import ANY, Mock, patch
 from nose.tools import eq_, ok_
 
-from rna import admin, fields, filters, models, views
+from rna import admin, fields, filters, models, search, sync, utils, views
+from rna.management.commands import export_json
 
 
-@patch('rna.management.commands.rnasync.sync_data')
+@patch('rna.management.commands.rnasync.sync_dump', return_value=3)
+@patch('sys.stdout', Mock())
 @override_settings(RNA_SYNC_URL='retrovirus')
 class RnaSyncCommandTests(TestCase):
-    def test_call_no_args(self, sync_data_mock):
+    def test_call_no_args(self, sync_dump_mock):
         call_command('rnasync')
-        sync_data_mock.assert_called_with(url='retrovirus', clean=False,
-                                          last_modified=None, api_token=None)
+        sync_dump_mock.assert_called_with('retrovirus', clean=False,
+                                          using='default')
 
-    def test_call_with_args(self, sync_data_mock):
-        call_command('rnasync', url='megavirus', clean=True)
-        sync_data_mock.assert_called_with(url='megavirus', clean=True,
-                                          last_modified=None, api_token=None)
+    def test_call_with_args(self, sync_dump_mock):
+        call_command('rnasync', url='megavirus', clean=True, database='other')
+        sync_dump_mock.assert_called_with('megavirus', clean=True,
+                                          using='other')
+
+    @patch('rna.management.commands.rnasync.sync_feed', return_value=3)
+    def test_call_feed(self, sync_feed_mock, sync_dump_mock):
+        call_command('rnasync', feed=True, clean=True)
+        sync_feed_mock.assert_called_with('retrovirus/changes/', clean=True,
+                                          using='default')
+        ok_(not sync_dump_mock.called)
 
 
 class TimeStampedModelTest(TestCase):
@@ -93,12 +114,105 @@ class ReleaseTest(TestCase):
                                  version='12.0.1')
         eq_(unicode(release), 'Firefox 12.0.1 Release')
 
+    def test_version_key(self):
+        """
+        Should sort versions numerically, then by alpha, beta, release
+        """
+        versions = ['10.0', '9.0', '42.0a2', '42.0.1', '42.0', '42.0beta',
+                    '42.0b10', '42.0b9']
+        eq_(sorted(versions, key=models.get_version_key),
+            ['9.0', '10.0', '42.0a2', '42.0beta', '42.0b9', '42.0b10', '42.0',
+             '42.0.1'])
+
+    def test_save_version_key(self):
+        """
+        Should store the version key when saved
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0b3',
+            release_date=datetime(2015, 11, 3))
+        eq_(release.version_key, models.get_version_key('42.0b3'))
+
+    def test_migrate_versions(self):
+        """
+        Should rename .0.0 versions and update what is derived from them
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Beta', version='42.0.0',
+            release_date=datetime(2015, 11, 3))
+        utils.migrate_versions()
+        release = models.Release.objects.get(pk=release.pk)
+        eq_(release.version, '42.0beta')
+        eq_(release.version_key, models.get_version_key('42.0beta'))
+        eq_(release.slug, 'firefox-42.0beta-beta')
+        eq_(search.search_ids(models.Release, '42.0beta'), [release.pk])
+
+    def test_ordering(self):
+        """
+        Should order releases with the same version key by version
+        """
+        for version in ('42.0', '42.0.0', '42', '42.0.0.0'):
+            models.Release.objects.create(
+                product='Firefox', channel='Release', version=version,
+                release_date=datetime(2015, 11, 3))
+        eq_(list(models.Release.objects.values_list('version', flat=True)),
+            ['42.0.0.0', '42.0.0', '42.0', '42'])
+
     def test_major_version(self):
         """
         Should return the version up to, but not including, the first dot
         """
         eq_(models.Release(version='42.0').major_version(), '42')
 
+    def test_save_version_major(self):
+        """
+        Should store the major version when saved
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0.1',
+            release_date=datetime(2015, 11, 3))
+        eq_(release.version_major, '42')
+
+    def test_get_slug(self):
+        """
+        Should slugify the product, and file ESRs under firefox and esr
+        """
+        eq_(models.get_slug('Firefox for Android', '42.0', 'Beta'),
+            'firefox-for-android-42.0-beta')
+        eq_(models.get_slug('Firefox Extended Support Release', '38.4.0',
+                            'Release'), 'firefox-38.4.0-esr')
+
+    def test_save_slug(self):
+        """
+        Should store the slug when saved, and find releases by it
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        eq_(release.slug, 'firefox-42.0-release')
+        release.version = '42.0.1'
+        release.save()
+        eq_(models.Release.objects.get_by_slug('firefox-42.0.1-release'),
+            release)
+        eq_(models.Release.objects.get_by_slug('firefox-42.0-release'), None)
+
+    def test_shared_slug(self):
+        """
+        Should allow ESR releases of both ESR products, and find the oldest
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='ESR', version='52.0',
+            release_date=datetime(2017, 3, 7))
+        models.Release.objects.create(
+            product='Firefox Extended Support Release', channel='ESR',
+            version='52.0', release_date=datetime(2017, 3, 7))
+        eq_(models.Release.objects.get_by_slug('firefox-52.0-esr'), release)
+        eq_(models.Release.objects.get_by_slug(
+            'firefox-52.0-esr', models.Release.objects.exclude(
+                pk=release.pk)).product, 'Firefox Extended Support Release')
+        response = self.client.get('/releases/firefox-52.0-esr/')
+        eq_(json.loads(response.content)['id'], release.pk)
+
     def test_get_bug_search_url(self):
         """
         Should return self.bug_search_url
@@ -131,39 +245,83 @@ class ReleaseTest(TestCase):
             '&resolution=FIXED'
             )
 
+    def create_notes(self):
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        fixed_in = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0.1',
+            release_date=datetime(2015, 11, 10))
+        notes = {}
+        for name, attrs in [
+                ('new_feature_1', {'tag': 'Changed'}),
+                ('new_feature_2', {}),
+                ('new_feature_3', {'tag': 'Fixed', 'sort_num': 5}),
+                ('dot_fix', {'tag': 'Fixed', 'note': '42.0.1 rendering glitches'}),
+                ('known_issue_1', {'is_known_issue': True, 'sort_num': 1}),
+                ('known_issue_2', {'is_known_issue': True, 'tag': 'Fixed',
+                                   'fixed_in_release': fixed_in}),
+                ('fixed_here', {'is_known_issue': True, 'tag': 'New',
+                                'fixed_in_release': release}),
+                ('private', {'is_public': False, 'sort_num': 10})]:
+            notes[name] = models.Note.objects.create(**attrs)
+            notes[name].releases.add(release)
+        return release, notes
+
     def test_notes(self):
         """
         Should split notes into new features and known issues.
         """
-        new_feature_1 = Mock(**{'is_known_issue_for.return_value': False,
-                                'tag': 'Changed'})
-        new_feature_2 = Mock(**{'is_known_issue_for.return_value': False})
-        dot_fix = Mock(**{'is_known_issue_for.return_value': False,
-                          'tag': 'Fixed',
-                          'note': '42.0.1 rendering glitches'})
-        known_issue_1 = Mock(**{'is_known_issue_for.return_value': True})
-        known_issue_2 = Mock(**{'is_known_issue_for.return_value': True})
-
-        with patch.object(models.Release, 'note_set') as note_set:
-            release = models.Release()
-            note_set.order_by.return_value = [
-                new_feature_2, new_feature_1, dot_fix, known_issue_1,
-                known_issue_2]
+        release, notes = self.create_notes()
+        with self.assertNumQueries(1):
             new_features, known_issues = release.notes()
-            note_set.order_by.assert_called_with('-sort_num', 'created')
 
-        eq_(new_features, [dot_fix, new_feature_2, new_feature_1])
-        eq_(known_issues, [known_issue_1, known_issue_2])
+        eq_(new_features, [notes[n] for n in [
+            'dot_fix', 'private', 'new_feature_2', 'fixed_here',
+            'new_feature_1', 'new_feature_3']])
+        eq_(known_issues, [notes['known_issue_1'], notes['known_issue_2']])
 
     def test_notes_public_only(self):
         """
         Should filter notes based on is_public attr.
         """
-        with patch.object(models.Release, 'note_set') as note_set:
-            release = models.Release()
-            release.notes(public_only=True)
-            note_set.order_by.return_value.filter.assert_called_with(
-                is_public=True)
+        release, notes = self.create_notes()
+        new_features, known_issues = release.notes(public_only=True)
+        ok_(notes['private'] not in new_features)
+        eq_(len(new_features), 5)
+
+    def test_notes_prefetched(self):
+        """
+        Should group and sort prefetched notes the same way
+        """
+        release, notes = self.create_notes()
+        expected = release.notes(public_only=True)
+        release = models.Release.objects.with_sorted_notes().get(pk=release.pk)
+        with self.assertNumQueries(0):
+            eq_(release.notes(public_only=True), expected)
+
+    def test_notes_dot_fix_case(self):
+        """
+        Should only count notes starting with the exact version as dot fixes
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Aurora', version='42.0a1',
+            release_date=datetime(2015, 11, 3))
+        for note in ('Crash fix', '42.0A1 crash fix'):
+            release.note_set.add(models.Note.objects.create(
+                note=note, tag='Fixed'))
+        new_features, known_issues = release.notes()
+        eq_([n.note for n in new_features], ['Crash fix', '42.0A1 crash fix'])
+        release = models.Release.objects.with_sorted_notes().get(pk=release.pk)
+        eq_(release.notes(), (new_features, known_issues))
+
+    def create_releases(self, *versions, **kwargs):
+        kwargs.setdefault('product', 'Firefox')
+        kwargs.setdefault('channel', 'Release')
+        kwargs.setdefault('is_public', True)
+        for version in versions:
+            models.Release.objects.create(
+                version=version, release_date=datetime(2015, 11, 3), **kwargs)
 
     @override_settings(DEV=True)
     def test_equivalent_release_for_product_dev(self):
@@ -171,16 +329,14 @@ class ReleaseTest(TestCase):
         Should return the release for the specified product with
         the same channel and major version
         """
+        self.create_releases('42.0', '43.0', '420.0')
+        self.create_releases('42.0.1', is_public=False)
+        self.create_releases('42.0.2', channel='Beta')
+        self.create_releases('42.0.3', product='Firefox for Android')
         release = models.Release(version='42.0', channel='Release')
-        release._default_manager = Mock()
-        mock_order_by = release._default_manager.filter.return_value.order_by
-        mock_order_by.return_value = [
-            models.Release(version='42.0'), models.Release(version='42.0.1')]
-        eq_(release.equivalent_release_for_product('Firefox').version,
-            '42.0.1')
-        release._default_manager.filter.assert_called_once_with(
-            version__startswith='42.', channel='Release', product='Firefox')
-        mock_order_by.assert_called_once_with('-version')
+        with self.assertNumQueries(1):
+            eq_(release.equivalent_release_for_product('Firefox').version,
+                '42.0.1')
 
     @override_settings(DEV=False)
     def test_equivalent_release_for_product_prod(self):
@@ -189,18 +345,11 @@ class ReleaseTest(TestCase):
         the same channel and major version, with an additional filter
         is_public=True
         """
+        self.create_releases('42.0', '42.0.1')
+        self.create_releases('42.0.2', is_public=False)
         release = models.Release(version='42.0', channel='Release')
-        release._default_manager = Mock()
-        mock_order_by = release._default_manager.filter.return_value.order_by
-        mock_public_filter = Mock(
-            return_value=[
-                models.Release(version='42.0'), models.Release(version='42.0.1')])
-        mock_order_by.return_value = Mock(filter=mock_public_filter)
         eq_(release.equivalent_release_for_product('Firefox').version,
             '42.0.1')
-        release._default_manager.filter.assert_called_once_with(
-            version__startswith='42.', channel='Release', product='Firefox')
-        mock_public_filter.assert_called_once_with(is_public=True)
 
     @override_settings(DEV=False)
     def test_equivalent_release_for_product_33_1(self):
@@ -208,27 +357,26 @@ class ReleaseTest(TestCase):
         Should order by 2nd version # for 33.1 after applying other
         sorting criteria
         """
+        self.create_releases('33.0.3', '33.1')
         release = models.Release(version='33.1', channel='Release')
-        release._default_manager = Mock()
-        mock_order_by = release._default_manager.filter.return_value.order_by
-        mock_public_filter = Mock(
-            return_value=[
-                models.Release(version='33.0.3'), models.Release(version='33.1')])
-        mock_order_by.return_value = Mock(filter=mock_public_filter)
         eq_(release.equivalent_release_for_product('Firefox').version,
             '33.1')
-        release._default_manager.filter.assert_called_once_with(
-            version__startswith='33.', channel='Release', product='Firefox')
-        mock_public_filter.assert_called_once_with(is_public=True)
+
+    @override_settings(DEV=False)
+    def test_equivalent_release_for_product_numeric(self):
+        """
+        Should compare version numbers numerically
+        """
+        self.create_releases('38.9.0', '38.10.0', '38.10.0.1')
+        release = models.Release(version='38.1.0', channel='Release')
+        eq_(release.equivalent_release_for_product('Firefox').version,
+            '38.10.0.1')
 
     def test_no_equivalent_release_for_product(self):
         """
         Should return None for empty querysets
         """
         release = models.Release(version='42.0', channel='Release')
-        release._default_manager = Mock()
-        release._default_manager.filter.return_value.order_by.return_value = \
-            models.Release.objects.none()
         eq_(release.equivalent_release_for_product('Firefox'), None)
 
     def test_equivalent_android_release(self):
@@ -375,10 +523,170 @@ class TimestampedFilterBackendTest(TestCase):
         eq_(mock_super_get_filter_class.called, 0)
 
 
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.notes = [models.Note.objects.create(note=str(i)) for i in range(5)]
+        # ties are broken by id
+        models.Note.objects.filter(pk__in=[n.pk for n in self.notes[1:4]]).update(
+            modified=self.notes[1].modified)
+
+    def walk(self, params):
+        pages = []
+        url = '/notes/'
+        while url:
+            page = json.loads(self.client.get(url, params).content)
+            pages.append([note['id'] for note in page['results']])
+            url, params = page['next'], None
+        return pages
+
+    def test_walk(self):
+        """
+        Should page through every note once in (modified, id) order
+        """
+        ids = [n.pk for n in self.notes]
+        eq_(self.walk({'page_size': 2}), [ids[:2], ids[2:4], ids[4:]])
+
+    def test_modified_after(self):
+        """
+        Should only page through notes modified since modified_after
+        """
+        ids = [n.pk for n in self.notes]
+        eq_(self.walk({'page_size': 2,
+                       'modified_after': self.notes[1].modified.isoformat()}),
+            [ids[1:3], ids[3:]])
+
+    def test_unpaginated(self):
+        """
+        Should return the whole list without a cursor or page_size
+        """
+        eq_(len(json.loads(self.client.get('/notes/').content)), 5)
+
+    def test_invalid_cursor(self):
+        """
+        Should respond with 404 Not Found
+        """
+        eq_(self.client.get('/releases/', {'cursor': 'nope'}).status_code, 404)
+
+
+class ConditionalResponseTest(TestCase):
+    def setUp(self):
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.url = '/releases/{}/'.format(self.release.pk)
+
+    def test_detail(self):
+        """
+        Should respond with 304 Not Modified without serializing until the
+        release is modified
+        """
+        etag = self.client.get(self.url)['ETag']
+        with patch('rna.views.ReleaseViewSet.get_serializer') as serializer:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 304)
+        ok_(not serializer.called)
+        self.release.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        ok_(response['ETag'] != etag)
+
+    def test_detail_note_releases(self):
+        """
+        Should change the ETag of a note when its releases change
+        """
+        note = models.Note.objects.create(note='Shiny')
+        url = '/notes/{}/'.format(note.pk)
+        etag = self.client.get(url)['ETag']
+        self.release.note_set.add(note)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        eq_(len(json.loads(response.content)['releases']), 1)
+
+    def test_detail_media_type(self):
+        """
+        Should vary the ETag with the negotiated media type
+        """
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        eq_(response['Vary'], 'Accept')
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_ACCEPT='text/html',
+                                   HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        ok_(response['ETag'] != etag)
+
+    def test_detail_if_modified_since(self):
+        """
+        Should respond with 304 Not Modified to a current If-Modified-Since
+        """
+        last_modified = self.client.get(self.url)['Last-Modified']
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        eq_(response.status_code, 304)
+
+    def test_list(self):
+        """
+        Should change the ETag when the filtered list changes
+        """
+        etag = self.client.get('/releases/')['ETag']
+        eq_(self.client.get('/releases/', HTTP_IF_NONE_MATCH=etag).status_code,
+            304)
+        eq_(self.client.get('/releases/', {'channel': 'Beta'},
+                            HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        release = models.Release.objects.create(
+            product='Firefox', channel='Beta', version='43.0beta',
+            release_date=datetime(2015, 11, 3))
+        response = self.client.get('/releases/', HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        etag = response['ETag']
+        models.Release.objects.filter(pk=release.pk).delete()
+        eq_(self.client.get('/releases/', HTTP_IF_NONE_MATCH=etag).status_code,
+            200)
+
+
+@override_settings(MIDDLEWARE_CLASSES=(
+    'rna.middleware.ServerTimingMiddleware',
+    'django.middleware.common.CommonMiddleware',
+))
+class ServerTimingMiddlewareTest(TestCase):
+    def setUp(self):
+        models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+
+    @patch('rna.middleware.logger')
+    def test_server_timing(self, logger):
+        """
+        Should report queries and durations in a header and a log line
+        """
+        response = self.client.get('/releases/')
+        timing = dict(metric.split(';', 1)
+                      for metric in response['Server-Timing'].split(', '))
+        eq_(sorted(timing), ['db', 'encode', 'serialize', 'total'])
+        ok_(timing['db'].endswith(';desc="2 queries"'))
+        record = json.loads(logger.info.call_args[0][0])
+        eq_(record['path'], '/releases/')
+        eq_(record['queries'], 2)
+        ok_(record['encode_ms'] >= 0)
+        ok_(not any(c.force_debug_cursor for c in connections.all()))
+
+    @override_settings(RNA_SERVER_TIMING_SAMPLE_RATE=0)
+    @patch('rna.middleware.logger')
+    def test_sample_rate(self, logger):
+        """
+        Should skip requests outside of the sample
+        """
+        response = self.client.get('/releases/')
+        ok_(not response.has_header('Server-Timing'))
+        ok_(not logger.info.called)
+
+
 class URLsTest(TestCase):
     @patch('rest_framework.routers.DefaultRouter.register')
     @patch('rest_framework.routers.DefaultRouter.urls')
     def test_urls(self, mock_urls, mock_register):
+        import rna.urls
+        # other tests may already have imported the urlconf
+        reload(rna.urls)
+        self.addCleanup(reload, rna.urls)
         from . import urls
         mock_register.assert_any_call('notes', views.NoteViewSet)
         mock_register.assert_any_call('releases', views.ReleaseViewSet)
@@ -386,44 +694,1338 @@ class URLsTest(TestCase):
 
 
 class ReleaseAdminTest(TestCase):
-    @patch('rna.admin.ReleaseAdmin.message_user')
+    def setUp(self):
+        self.release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        self.note = models.Note.objects.create(note='Shiny')
+        self.releases = []
+        for product in ('Firefox', 'Firefox for Android', 'Thunderbird'):
+            release = models.Release.objects.create(
+                product=product, channel='Aurora', version='43.0a2',
+                release_date=datetime(2015, 11, 3), is_public=True)
+            release.note_set.add(self.note)
+            self.releases.append(release)
+
+    def copy(self, releases):
+        with patch.object(self.release_admin, 'message_user') as message_user:
+            self.release_admin.copy_releases(
+                'request', models.Release.objects.filter(
+                    pk__in=[r.pk for r in releases]).order_by('pk'))
+        return message_user
+
     @patch('rna.admin.now')
-    def test_copy_releases(self, mock_now, mock_message_user):
-        mock_release_model = Mock()
-        mock_release_model.objects.filter.return_value.count.return_value = 1
-        release_admin = admin.ReleaseAdmin(mock_release_model, 'admin_site')
-        mock_release = Mock(id=1, version='42.0', product='Firefox')
-        mock_release.note_set.all.return_value = ['note']
-
-        release_admin.copy_releases('request', [mock_release])
-
-        mock_release_model.objects.filter.assert_called_once_with(
-            version__endswith='42.0', product='Firefox')
-        eq_(mock_release.id, None)
-        eq_(mock_release.version, 'copy-42.0')
-        mock_release.save.assert_called_once_with()
-        mock_release.note_set.add.assert_called_once_with('note')
-        mock_release.note_set.update.assert_called_once_with(
-            modified=mock_now.return_value)
-        mock_message_user.assert_called_once_with('request', 'Copied Release')
+    def test_copy_releases(self, mock_now):
+        """
+        Should copy releases with their notes as private copy-<version>
+        """
+        mock_now.return_value = datetime(2015, 11, 4)
+        message_user = self.copy(self.releases[:1])
+        copy = models.Release.objects.get(version='copy-43.0a2')
+        eq_(copy.product, 'Firefox')
+        ok_(not copy.is_public)
+        eq_(copy.version_key, models.get_version_key('copy-43.0a2'))
+        eq_(list(copy.note_set.all()), [self.note])
+        eq_(models.Note.objects.get().modified, mock_now.return_value)
+        eq_(json.loads(copy.rendered.data)['notes'][0]['id'], self.note.pk)
+        message_user.assert_called_once_with('request', 'Copied Release')
+
+    def test_2nd_copy_releases(self):
+        """
+        Should number further copies, counting copies in the same batch
+        """
+        self.copy(self.releases[:1])
+        release = models.Release.objects.create(
+            product='Firefox', channel='Aurora', version='3.0a2',
+            release_date=datetime(2015, 11, 3))
+        message_user = self.copy([self.releases[0], release])
+        eq_(sorted(models.Release.objects.filter(product='Firefox').values_list(
+            'version', flat=True)),
+            ['3.0a2', '43.0a2', 'copy-43.0a2', 'copy2-43.0a2', 'copy4-3.0a2'])
+        message_user.assert_called_once_with('request', 'Copied 2 Releases')
+
+    def test_copy_releases_atomic(self):
+        """
+        Should lock the releases of the products and count the copies in
+        the same transaction as creating them
+        """
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.copy(self.releases[:1])
+        sql = [q['sql'] for q in queries]
+        start = [i for i, q in enumerate(sql) if 'SAVEPOINT' in q][0]
+        ok_('"rna_release"."product" IN' in sql[start + 1])
+        ok_('SUM(CASE' in sql[start + 2])
+        ok_('INSERT INTO "rna_release"' in sql[start + 3])
+
+    def test_copy_releases_queries(self):
+        """
+        Should copy any number of releases in the same number of queries
+        """
+        with self.assertNumQueries(26):
+            self.copy(self.releases[:1])
+        models.Release.objects.filter(version__startswith='copy').delete()
+        with self.assertNumQueries(26):
+            self.copy(self.releases)
+        eq_(models.Release.objects.filter(version='copy-43.0a2').count(), 3)
+        eq_(models.Note.releases.through.objects.count(), 6)
+
+
+class NoteAdminTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'secret')
+        self.note_admin = admin.NoteAdmin(models.Note, site)
+        self.note = models.Note.objects.create(bug=1234, note='Shiny')
+        models.Note.objects.create(bug=5678, note='Dull')
+        for product in ('Firefox', 'Firefox for Android'):
+            release = models.Release.objects.create(
+                product=product, channel='Release', version='43.0',
+                release_date=datetime(2015, 11, 3))
+            release.note_set.add(self.note)
+        cache.clear()
+
+    def changelist(self, **params):
+        request = RequestFactory().get('/admin/rna/note/', params)
+        request.user = self.user
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.note_admin.changelist_view(request).render()
+        eq_(response.status_code, 200)
+        ok_(not any('DISTINCT' in q['sql'] for q in queries))
+        return response
+
+    def test_version_filter(self):
+        """
+        Should filter by a typed version without duplicating notes
+        """
+        response = self.changelist(version='43.0')
+        eq_(list(response.context_data['cl'].result_list), [self.note])
+        ok_('name="version" value="43.0"' in response.content)
+
+    def test_product_filter(self):
+        response = self.changelist(product='Firefox for Android')
+        eq_(list(response.context_data['cl'].result_list), [self.note])
+
+    def test_search_version(self):
+        response = self.changelist(q='43.0')
+        eq_(list(response.context_data['cl'].result_list), [self.note])
+        response = self.changelist(q='Dull')
+        eq_(response.context_data['cl'].result_count, 1)
+
+    def test_count(self):
+        """
+        Should cache the count
+        """
+        eq_(self.changelist().context_data['cl'].result_count, 2)
+        models.Note.objects.all().delete()
+        eq_(self.changelist().context_data['cl'].result_count, 2)
+
+    @patch('rna.admin.estimate_count', return_value=20000)
+    def test_count_estimate(self, estimate_count):
+        """
+        Should estimate the count of whole tables of more than estimate_over
+        rows, so that every page can be reached
+        """
+        cl = self.changelist().context_data['cl']
+        eq_(cl.result_count, 20000)
+        eq_(cl.paginator.num_pages, 200)
+        eq_(self.changelist(product='Firefox').context_data['cl'].result_count,
+            1)
+        estimate_count.return_value = 100
+        eq_(self.changelist().context_data['cl'].result_count, 2)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='43.0',
+            release_date=datetime(2015, 11, 3), text='Faster startup')
+        self.note = models.Note.objects.create(
+            bug=1234, note='Improved scrolling performance on long pages')
+        self.other_note = models.Note.objects.create(
+            bug=5678, note='Scrolling bar is themed')
+        self.note.releases.add(self.release)
+
+    def test_search(self):
+        """
+        Should rank notes matching every word, with a snippet
+        """
+        results = search.search(models.Note, 'scrolling performance')
+        eq_([pk for pk, rank, snippet in results], [self.note.pk])
+        ok_('**scrolling**' in results[0][2])
+        eq_(search.search_ids(models.Note, '5678'), [self.other_note.pk])
+        eq_(search.search(models.Note, '"'), [])
+        eq_(search.search(models.Note, ' '), [])
+
+    def test_updated_on_save_and_delete(self):
+        self.note.note = 'Smoother video'
+        self.note.save()
+        eq_(search.search_ids(models.Note, 'performance'), [])
+        eq_(search.search_ids(models.Note, 'video'), [self.note.pk])
+        self.note.delete()
+        eq_(search.search_ids(models.Note, 'video'), [])
+
+    def test_search_releases(self):
+        eq_(search.search_ids(models.Release, 'startup'), [self.release.pk])
+        eq_(search.search_ids(models.Release, 'firefox 43.0'),
+            [self.release.pk])
+
+    @patch.dict(search._indexed, {'default': False})
+    def test_not_indexed(self):
+        """
+        Should fall back to icontains without an index
+        """
+        eq_(search.search_ids(models.Note, 'SCROLLING PERF'), [self.note.pk])
+
+    def test_admin(self):
+        note_admin = admin.NoteAdmin(models.Note, site)
+        results, use_distinct = note_admin.get_search_results(
+            None, models.Note.objects.all(), 'scrolling')
+        eq_(set(results), set([self.note, self.other_note]))
+        ok_(not use_distinct)
+        release_admin = admin.ReleaseAdmin(models.Release, site)
+        results, use_distinct = release_admin.get_search_results(
+            None, models.Release.objects.all(), 'startup')
+        eq_(list(results), [self.release])
+
+    def test_admin_prefix(self):
+        """
+        Should match words and versions by their start
+        """
+        note_admin = admin.NoteAdmin(models.Note, site)
+        results, use_distinct = note_admin.get_search_results(
+            None, models.Note.objects.all(), 'scroll perf')
+        eq_(list(results), [self.note])
+        release_admin = admin.ReleaseAdmin(models.Release, site)
+        alpha, beta = [models.Release.objects.create(
+            product='Firefox', channel=channel, version=version,
+            release_date=datetime(2015, 11, 3))
+            for channel, version in (('Aurora', '42.0a2'),
+                                     ('Beta', '42.0beta'))]
+        for term, expected in (('42.0', set([alpha, beta])),
+                               ('42.0a', set([alpha])),
+                               ('start', set([self.release]))):
+            results, use_distinct = release_admin.get_search_results(
+                None, models.Release.objects.all(), term)
+            eq_(set(results), expected)
+            eq_(set(search.filter_matching(
+                models.Release.objects.all(), term)), expected)
+
+    def test_filter_matching(self):
+        """
+        Should filter with a subquery of the index, in one query
+        """
+        notes = search.filter_matching(
+            models.Note.objects.filter(releases=self.release), 'scrolling')
+        with self.assertNumQueries(1):
+            eq_(list(notes), [self.note])
+        ok_('rna_note_search' in str(notes.query))
+        eq_(list(search.filter_matching(models.Note.objects.all(), ' ')), [])
+        with patch.dict(search._indexed, {'default': False}):
+            eq_(list(search.filter_matching(
+                models.Note.objects.all(), 'themed')), [self.other_note])
+
+    def test_view(self):
+        response = self.client.get('/notes/search/', {'q': 'scrolling'})
+        eq_(response.status_code, 200)
+        data = json.loads(response.content)
+        eq_(len(data), 2)
+        result = [r for r in data if r['id'] == self.note.pk][0]
+        eq_(result['bug'], 1234)
+        eq_(result['releases'], ['firefox-43.0-release'])
+        ok_('**scrolling**' in result['snippet'].lower())
+        response = self.client.get('/notes/search/', {'q': 'scrolling',
+                                                      'limit': 1})
+        eq_(len(json.loads(response.content)), 1)
+        response = self.client.get('/notes/search/', {'limit': 'x'})
+        eq_(response.status_code, 400)
+
+    def test_rnarebuild(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('DELETE FROM rna_note_search')
+        eq_(search.search_ids(models.Note, 'themed'), [])
+        with patch('sys.stdout'):
+            call_command('rnarebuild', 'search')
+        eq_(search.search_ids(models.Note, 'themed'), [self.other_note.pk])
+
+
+class BugReleaseTest(TestCase):
+    def setUp(self):
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='43.0',
+            release_date=datetime(2015, 11, 3),
+            bug_list='1234, bug 567890; 12 and 99999999999')
+        self.other_release = models.Release.objects.create(
+            product='Firefox', channel='Beta', version='43.0beta',
+            release_date=datetime(2015, 11, 2))
+        self.note = models.Note.objects.create(bug=567890, note='Shiny')
+        self.note.releases.add(self.other_release)
+
+    def bugs(self):
+        return sorted(models.BugRelease.objects.values_list(
+            'bug', 'release'))
+
+    def test_parse_bug_list(self):
+        eq_(models.parse_bug_list('1234, bug 567890; 12 and 99999999999'),
+            set([1234, 567890]))
+
+    def test_updated(self):
+        """
+        Should index the bugs of bug_list and notes as they change
+        """
+        eq_(self.bugs(), [(1234, self.release.pk),
+                          (567890, self.release.pk),
+                          (567890, self.other_release.pk)])
+        self.release.bug_list = '2345'
+        self.release.save()
+        self.note.bug = 678901
+        self.note.save()
+        self.note.releases.add(self.release)
+        eq_(self.bugs(), [(2345, self.release.pk),
+                          (678901, self.release.pk),
+                          (678901, self.other_release.pk)])
+        self.note.delete()
+        eq_(self.bugs(), [(2345, self.release.pk)])
+
+    def test_view(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/bugs/567890/releases/')
+        eq_(sorted(r['id'] for r in json.loads(response.content)),
+            sorted([self.release.pk, self.other_release.pk]))
+        response = self.client.get('/bugs/1234/releases/')
+        eq_([r['id'] for r in json.loads(response.content)],
+            [self.release.pk])
+        eq_(json.loads(self.client.get('/bugs/4321/releases/').content), [])
+        with patch('rna.views.models.Release.objects.filter') as filter_:
+            response = self.client.get('/bugs/99999999999/releases/')
+        eq_(json.loads(response.content), [])
+        ok_(not filter_.called)
+
+    def test_rnarebuild(self):
+        models.BugRelease.objects.all().delete()
+        with patch('sys.stdout'):
+            call_command('rnarebuild', 'bugs')
+        eq_(len(self.bugs()), 3)
+
+
+class ReleaseDiffTest(TestCase):
+    def setUp(self):
+        self.beta = models.Release.objects.create(
+            product='Firefox', channel='Beta', version='43.0beta',
+            release_date=datetime(2015, 11, 3), text='Beta')
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='43.0',
+            release_date=datetime(2015, 11, 10), text='Beta',
+            is_public=True)
+        self.shared = models.Note.objects.create(note='Shared')
+        self.removed = models.Note.objects.create(note='Backed out')
+        self.added = models.Note.objects.create(note='Uplifted')
+        self.fixed = models.Note.objects.create(
+            note='Crash', is_known_issue=True, fixed_in_release=self.release)
+        self.beta.note_set.add(self.shared, self.removed, self.fixed)
+        self.release.note_set.add(self.shared, self.added, self.fixed)
+
+    def test_diff(self):
+        """
+        Should report differing fields and added, removed and changed notes
+        """
+        with self.assertNumQueries(3):
+            diff = self.beta.diff(self.release)
+        eq_(diff['from']['slug'], 'firefox-43.0beta-beta')
+        eq_(diff['to']['slug'], 'firefox-43.0-release')
+        eq_(diff['fields'], {
+            'channel': ['Beta', 'Release'],
+            'version': ['43.0beta', '43.0'],
+            'release_date': ['2015-11-03', '2015-11-10'],
+            'is_public': [False, True],
+        })
+        eq_([n['id'] for n in diff['notes_added']], [self.added.pk])
+        eq_(diff['notes_removed'], [self.removed.pk])
+        eq_(diff['notes_changed'], [{'id': self.fixed.pk,
+                                     'is_known_issue': [True, False]}])
+
+    def test_same(self):
+        diff = self.release.diff(self.release)
+        eq_((diff['fields'], diff['notes_added'], diff['notes_removed'],
+             diff['notes_changed']), ({}, [], [], []))
+
+    def test_view(self):
+        response = self.client.get('/releases/{}/diff/{}/'.format(
+            self.beta.slug, self.release.pk))
+        eq_(response['Content-Type'], 'application/json')
+        eq_(json.loads(response.content),
+            json.loads(json.dumps(self.beta.diff(self.release))))
+        eq_(self.client.get('/releases/{}/diff/firefox-1.0-release/'.format(
+            self.beta.pk)).status_code, 404)
+
+
+class ReleaseManagerTest(TestCase):
+    def setUp(self):
+        self.release_1 = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.release_2 = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0.1',
+            release_date=datetime(2015, 11, 10))
+        self.release_3 = models.Release.objects.create(
+            product='Firefox for Android', channel='Beta', version='43.0beta',
+            release_date=datetime(2015, 11, 12))
+        fixed = models.Note.objects.create(
+            note='42.0.1 crash fix', tag='Fixed', sort_num=2)
+        known = models.Note.objects.create(
+            note='Crash on startup', is_known_issue=True,
+            fixed_in_release=self.release_2)
+        new = models.Note.objects.create(note='Shiny', tag='New')
+        fixed.releases.add(self.release_2)
+        known.releases.add(self.release_1, self.release_2, self.release_3)
+        new.releases.add(self.release_1, self.release_3)
+
+    def test_all_as_list(self):
+        """
+        Should return the same data as calling to_dict() on every release
+        """
+        expected = [r.to_dict() for r in models.Release.objects.all()]
+        eq_(models.Release.objects.all_as_list(), expected)
+
+    def test_all_as_list_num_queries(self):
+        """
+        Should not issue queries per release or per note
+        """
+        with self.assertNumQueries(2):
+            models.Release.objects.all_as_list()
+        models.Release.objects.create(
+            product='Thunderbird', channel='Release', version='38.0',
+            release_date=datetime(2015, 6, 1)).note_set.add(
+                *models.Note.objects.all())
+        with self.assertNumQueries(2):
+            models.Release.objects.all_as_list()
+
+
+class IterJSONListTest(TestCase):
+    def test_iter_json_list(self):
+        """
+        Should produce the same output as json.dumps on a list
+        """
+        for data in ([], [{'a': 1}], [{'a': 1}, {'b': [2, 3]}, 'c']):
+            eq_(''.join(utils.iter_json_list(iter(data))), json.dumps(data))
+
+
+class ExportJSONViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        models.Note.objects.create(note='Shiny', tag='New').releases.add(
+            release)
+        models.Release.objects.create(
+            product='Firefox', channel='Beta', version='43.0beta',
+            release_date=datetime(2015, 11, 12))
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_export_json(self):
+        """
+        Should return all releases as a JSON list
+        """
+        response = self.client.get('/all-releases.json')
+        eq_(response['Content-Type'], 'application/json')
+        eq_(response.content,
+            json.dumps(models.Release.objects.all_as_list()))
+
+    @override_settings(RNA_JSON_STREAMING=True)
+    def test_export_json_streaming(self):
+        """
+        Should stream a byte-identical response
+        """
+        response = self.client.get('/all-releases.json')
+        ok_(response.streaming)
+        eq_(response['Content-Type'], 'application/json')
+        eq_(b''.join(response.streaming_content),
+            json.dumps(models.Release.objects.all_as_list()))
+
+    @override_settings(RNA_JSON_STREAMING=True)
+    def test_export_json_streaming_gzip(self):
+        """
+        Should stream gzip to clients that accept it
+        """
+        with patch('rna.views.get_export_artifact') as get_export_artifact:
+            response = self.client.get('/all-releases.json',
+                                       HTTP_ACCEPT_ENCODING='br, gzip')
+        ok_(not get_export_artifact.called)
+        ok_(response.streaming)
+        eq_(response['Content-Encoding'], 'gzip')
+        content = b''.join(response.streaming_content)
+        eq_(gzip.GzipFile(fileobj=StringIO(content)).read(),
+            json.dumps(models.Release.objects.all_as_list()))
+
+    def test_iter_gzip(self):
+        data = ''.join(utils.iter_gzip(['abc'] * 1000, chunk_size=10))
+        eq_(data, utils.compress('abc' * 1000, 'gzip'))
+
+    def test_export_json_gzip(self):
+        """
+        Should serve the gzip artifact to clients that accept it, building
+        it once per change
+        """
+        with patch('rna.utils.compress', side_effect=utils.compress) as compress:
+            self.client.get('/all-releases.json', HTTP_ACCEPT_ENCODING='gzip')
+            response = self.client.get('/all-releases.json',
+                                       HTTP_ACCEPT_ENCODING='gzip, deflate')
+            eq_(compress.call_count, 1)
+        eq_(response['Content-Encoding'], 'gzip')
+        eq_(response['Vary'], 'Accept-Encoding')
+        eq_(gzip.GzipFile(fileobj=StringIO(response.content)).read(),
+            json.dumps(models.Release.objects.all_as_list()))
+
+        models.Release.objects.get(channel='Beta').delete()
+        response = self.client.get('/all-releases.json',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        eq_(json.loads(gzip.GzipFile(fileobj=StringIO(response.content)).read()),
+            json.loads(json.dumps(models.Release.objects.all_as_list())))
+
+    def test_export_ndjson(self):
+        """
+        Should stream one release per line
+        """
+        response = self.client.get('/all-releases.ndjson')
+        ok_(response.streaming)
+        eq_(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).splitlines()
+        eq_([json.loads(line) for line in lines],
+            json.loads(json.dumps(models.Release.objects.all_as_list())))
+
+    def test_choose_encoding(self):
+        """
+        Should choose the preferred encoding the client accepts
+        """
+        with patch('rna.utils.brotli', None):
+            eq_(utils.choose_encoding('gzip, deflate, br'), 'gzip')
+        with patch('rna.utils.brotli', Mock()):
+            eq_(utils.choose_encoding('gzip, deflate, br'), 'br')
+            eq_(utils.choose_encoding('gzip, br;q=0'), 'gzip')
+        eq_(utils.choose_encoding('deflate'), 'identity')
+        eq_(utils.choose_encoding(''), 'identity')
+
+    @patch('rna.utils.brotli')
+    def test_compress_brotli_quality(self, brotli):
+        """
+        Should compress with a moderate brotli quality
+        """
+        utils.compress(b'[]', 'br')
+        brotli.compress.assert_called_once_with(b'[]', quality=5)
+
+
+class ReleaseJSONViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.note = models.Note.objects.create(note='Shiny', tag='New')
+        self.note.releases.add(self.release)
+        self.esr = models.Release.objects.create(
+            product='Firefox Extended Support Release', channel='Release',
+            version='38.4.0', release_date=datetime(2015, 11, 3))
+
+    def tearDown(self):
+        cache.clear()
+
+    def get(self, key):
+        return self.client.get('/releases/{}/json/'.format(key))
+
+    def test_by_id_or_slug(self):
+        """
+        Should return the release's dict by id or slug
+        """
+        for release in (self.release, self.esr):
+            for key in (release.pk, release.slug):
+                response = self.get(key)
+                eq_(response['Content-Type'], 'application/json')
+                eq_(json.loads(response.content),
+                    json.loads(json.dumps(release.to_dict())))
+
+    def test_rest_by_slug(self):
+        """
+        Should look releases and their notes up by slug in the REST API
+        """
+        with self.assertNumQueries(1):
+            response = self.client.get('/releases/firefox-38.4.0-esr/')
+        eq_(json.loads(response.content)['id'], self.esr.pk)
+        eq_(json.loads(response.content)['slug'], 'firefox-38.4.0-esr')
+        response = self.client.get('/releases/{}/'.format(self.esr.pk))
+        eq_(json.loads(response.content)['id'], self.esr.pk)
+        eq_(self.client.get('/releases/firefox-1.0-release/').status_code,
+            404)
+        response = self.client.get('/releases/firefox-42.0-release/notes/')
+        eq_([n['id'] for n in json.loads(response.content)], [self.note.pk])
+
+    def test_not_found(self):
+        """
+        Should respond with 404 for unknown ids and slugs
+        """
+        eq_(self.get(0).status_code, 404)
+        eq_(self.get('firefox-1.0-release').status_code, 404)
+        eq_(self.get('nope').status_code, 404)
+
+    def test_cached(self):
+        """
+        Should serve a release from the cache without queries
+        """
+        etag = self.get(self.release.pk)['ETag']
+        with self.assertNumQueries(0):
+            eq_(self.get(self.release.pk)['ETag'], etag)
+
+    def test_invalidation(self):
+        """
+        Should drop only the releases affected by a change
+        """
+        self.get(self.release.pk)
+        self.get(self.esr.pk)
+        self.note.note = 'Shinier'
+        self.note.save()
+        with self.assertNumQueries(0):
+            self.get(self.esr.pk)
+        eq_(json.loads(self.get(self.release.pk).content)['notes'][0]['note'],
+            'Shinier')
+        self.note.releases.remove(self.release)
+        eq_(json.loads(self.get(self.release.pk).content)['notes'], [])
+
+
+class ExportJSONCommandTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, self.tmp_dir)
+        self.output_dir = os.path.join(self.tmp_dir, 'json_export')
+        self.settings_override = override_settings(
+            RNA_JSON_EXPORT_DIR=self.output_dir)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.release_1 = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.release_2 = models.Release.objects.create(
+            product='Firefox Extended Support Release', channel='Release',
+            version='38.4.0', release_date=datetime(2015, 11, 3))
+        self.note = models.Note.objects.create(note='Shiny', tag='New')
+        self.note.releases.add(self.release_1, self.release_2)
+
+    def export(self, **options):
+        with patch('sys.stdout'):
+            call_command('export_json', **options)
+
+    def read(self, slug):
+        with open(os.path.join(self.output_dir, slug + '.json')) as fp:
+            return json.load(fp)
+
+    def list_json(self):
+        """The exported files, without the compressed copies"""
+        return sorted(f for f in os.listdir(self.output_dir)
+                      if f.endswith('.json'))
+
+    def test_export(self):
+        """
+        Should write one file per release to a published symlink
+        """
+        self.export()
+        ok_(os.path.islink(self.output_dir))
+        eq_(self.list_json(),
+            ['firefox-38.4.0-esr.json', 'firefox-42.0-release.json'])
+        eq_(self.read('firefox-42.0-release'),
+            json.loads(json.dumps(self.release_1.to_dict())))
+
+    def test_export_ndjson(self):
+        """
+        Should write a single file with one release per line
+        """
+        self.export(format='ndjson')
+        with open(self.output_dir + '.ndjson') as fp:
+            eq_([json.loads(line) for line in fp],
+                json.loads(json.dumps(models.Release.objects.all_as_list())))
+        ok_(not os.path.exists(self.output_dir))
+
+    def test_export_compressed(self):
+        """
+        Should write a gzipped copy next to each file, and reuse it
+        """
+        self.export(incremental=True)
+        path = os.path.join(self.output_dir, 'firefox-42.0-release.json')
+        with open(path) as fp, gzip.open(path + '.gz') as gz:
+            eq_(gz.read(), fp.read())
+        os.remove(os.path.realpath(path + '.gz'))
+        self.export(incremental=True)
+        with open(path) as fp, gzip.open(path + '.gz') as gz:
+            eq_(gz.read(), fp.read())
+
+    def test_export_replaces_plain_directory(self):
+        """
+        Should replace a directory left by older exports
+        """
+        os.mkdir(self.output_dir)
+        open(os.path.join(self.output_dir, 'stale.json'), 'w').close()
+        self.export()
+        ok_(os.path.islink(self.output_dir))
+        ok_('stale.json' not in os.listdir(self.output_dir))
+        eq_(os.listdir(self.tmp_dir).count('json_export.state.json'), 1)
+
+    @patch('rna.management.commands.export_json.render',
+           side_effect=export_json.render)
+    def test_incremental(self, mock_render):
+        """
+        Should only render releases that changed since the last export
+        """
+        self.export(incremental=True)
+        eq_(mock_render.call_count, 2)
+
+        mock_render.reset_mock()
+        self.export(incremental=True)
+        eq_(mock_render.call_count, 0)
+        eq_(len(self.list_json()), 2)
+
+        mock_render.reset_mock()
+        self.note.note = 'Shinier'
+        self.note.save()
+        self.release_2.note_set.remove(self.note)
+        self.export(incremental=True)
+        eq_(mock_render.call_count, 2)
+        eq_(self.read('firefox-42.0-release')['notes'][0]['note'], 'Shinier')
+        eq_(self.read('firefox-38.4.0-esr')['notes'], [])
+
+    def test_incremental_fixed_in_release(self):
+        """
+        Should rewrite releases whose notes were fixed in a changed release
+        """
+        fix = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0.1',
+            release_date=datetime(2015, 11, 10))
+        self.note.is_known_issue = True
+        self.note.fixed_in_release = fix
+        self.note.save()
+        self.export(incremental=True)
+        fix.version = '42.0.2'
+        fix.is_public = True
+        fix.save()
+        self.export(incremental=True)
+        fixed_in = self.read('firefox-42.0-release')['notes'][0][
+            'fixed_in_release']
+        eq_((fixed_in['slug'], fixed_in['is_public']),
+            ('firefox-42.0.2-release', True))
+
+    @patch('rna.management.commands.export_json.connections')
+    @patch('rna.management.commands.export_json.Pool')
+    def test_workers(self, mock_pool, mock_connections):
+        """
+        Should export each product and channel shard in a worker pool
+        """
+        mock_pool.return_value.imap_unordered.side_effect = map
+        self.export(workers=4)
+        mock_pool.assert_called_once_with(4)
+        mock_connections.close_all.assert_called_once_with()
+        shards = [task[0] for task in
+                  mock_pool.return_value.imap_unordered.call_args[0][1]]
+        eq_(shards, ['Firefox Extended Support Release Release',
+                     'Firefox Release'])
+        eq_(self.list_json(),
+            ['firefox-38.4.0-esr.json', 'firefox-42.0-release.json'])
+        mock_pool.return_value.join.assert_called_once_with()
+
+    def test_incremental_deleted_release(self):
+        """
+        Should remove files of deleted releases
+        """
+        self.export(incremental=True)
+        self.release_2.delete()
+        self.export(incremental=True)
+        eq_([f for f in os.listdir(self.output_dir) if 'esr' in f], [])
+
+
+class RenderedReleaseTest(TestCase):
+    def setUp(self):
+        self.release_1 = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.release_2 = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0.1',
+            release_date=datetime(2015, 11, 10))
+        self.note = models.Note.objects.create(
+            note='Crash on startup', is_known_issue=True,
+            fixed_in_release=self.release_2)
+        self.note.releases.add(self.release_1)
+
+    def assert_current(self, release):
+        release = models.Release.objects.get(pk=release.pk)
+        eq_(json.loads(models.RenderedRelease.objects.get(release=release).data),
+            json.loads(json.dumps(release.to_dict())))
+
+    def test_note_saved(self):
+        """
+        Should refresh the releases of a saved note
+        """
+        self.note.note = 'Crash on shutdown'
+        self.note.save()
+        self.assert_current(self.release_1)
+
+    def test_note_releases_changed(self):
+        """
+        Should refresh releases added to or removed from a note
+        """
+        self.note.releases.add(self.release_2)
+        self.assert_current(self.release_2)
+        self.release_2.note_set.remove(self.note)
+        self.assert_current(self.release_2)
+        self.note.releases.clear()
+        self.assert_current(self.release_1)
+
+    def test_fixed_in_release_saved(self):
+        """
+        Should refresh releases with notes fixed in a saved release
+        """
+        self.release_2.is_public = True
+        self.release_2.save()
+        self.assert_current(self.release_1)
+        ok_(json.loads(models.RenderedRelease.objects.get(
+            release=self.release_1).data)['notes'][0]['fixed_in_release']['is_public'])
+
+    def test_note_deleted(self):
+        """
+        Should invalidate the releases of a deleted note
+        """
+        self.note.delete()
+        ok_(not models.RenderedRelease.objects.filter(
+            release=self.release_1).exists())
+        eq_(list(models.RenderedRelease.objects.iter_json()),
+            [json.dumps(r.to_dict()) for r in models.Release.objects.all()])
+
+    def test_raw_save(self):
+        """
+        Should only invalidate on raw saves
+        """
+        models.RenderedRelease.objects.refresh([self.release_1.pk])
+        self.note.save_base(raw=True)
+        ok_(not models.RenderedRelease.objects.filter(
+            release=self.release_1).exists())
+
+    def test_iter_json(self):
+        """
+        Should read stored JSON, rendering only what is missing
+        """
+        expected = [json.dumps(r.to_dict()) for r in models.Release.objects.all()]
+        eq_(list(models.RenderedRelease.objects.iter_json()), expected)
+        with self.assertNumQueries(2):
+            eq_(list(models.RenderedRelease.objects.iter_json()), expected)
+
+    def test_rnarebuild(self):
+        """
+        Should render every release
+        """
+        models.RenderedRelease.objects.all().delete()
+        with patch('sys.stdout'):
+            call_command('rnarebuild', 'rendered')
+        eq_(models.RenderedRelease.objects.count(), 2)
+        self.assert_current(self.release_1)
+        self.assert_current(self.release_2)
+
+    @patch('rna.signals.releases_changed')
+    def test_database(self, releases_changed):
+        """
+        Should update derived data in the database that changed
+        """
+        self.note.releases.remove(self.release_1)
+        releases_changed.assert_called_with(set([self.release_1.pk]),
+                                             modified=ANY, using='default')
+        self.note.releases.add(self.release_1)
+        self.note.delete()
+        releases_changed.assert_called_with([self.release_1.pk], raw=True,
+                                            using='default')
+
+    def test_refresh_concurrent(self):
+        """
+        Should update rows stored by another request in the meantime
+        """
+        models.RenderedRelease.objects.all().delete()
+        bulk_create = models.RenderedReleaseManager.bulk_create
+
+        def store_first(manager, objs):
+            bulk_create(manager, [models.RenderedRelease(
+                release=self.release_1, data='{}',
+                source_modified=datetime(2015, 11, 3))])
+            raise IntegrityError('duplicate key')
+
+        with patch.object(models.RenderedReleaseManager, 'bulk_create',
+                          store_first):
+            # the savepoint rolls back, so the row is stored outside it
+            with patch('rna.models.transaction.atomic') as atomic:
+                atomic.return_value.__exit__.return_value = False
+                rendered = models.RenderedRelease.objects.refresh(
+                    [self.release_1.pk])
+        eq_(rendered[self.release_1.pk],
+            json.dumps(models.Release.objects.get(
+                pk=self.release_1.pk).to_dict()))
+        self.assert_current(self.release_1)
+
+    def test_rnarebuild_everything(self):
+        """
+        Should rebuild everything without targets, and reject unknown ones
+        """
+        models.RenderedRelease.objects.all().delete()
+        with patch('sys.stdout'):
+            call_command('rnarebuild')
+        eq_(models.RenderedRelease.objects.count(), 2)
+        with self.assertRaises(CommandError):
+            call_command('rnarebuild', 'nope')
+
+
+class LastModifiedDateTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.note = models.Note.objects.create(note='Shiny')
+
+    def test_cached(self):
+        """
+        Should only query the database once
+        """
+        cache.clear()
+        with self.assertNumQueries(1):
+            eq_(utils.get_last_modified_date(), self.note.modified)
+        with self.assertNumQueries(0):
+            eq_(utils.get_last_modified_date(), self.note.modified)
+
+    def test_stored(self):
+        """
+        Should keep the date in the database, computing it only without one
+        """
+        models.Watermark.objects.all().delete()
+        cache.clear()
+        eq_(utils.get_last_modified_date(), self.note.modified)
+        eq_(models.Watermark.objects.get().modified, self.note.modified)
+        cache.clear()
+        models.Watermark.objects.update(modified=datetime(2001, 1, 1))
+        eq_(utils.get_last_modified_date(), datetime(2001, 1, 1))
+
+    def test_bump(self):
+        """
+        Should only move forward
+        """
+        utils.bump_last_modified_date(datetime(2001, 1, 1))
+        eq_(utils.get_last_modified_date(), self.note.modified)
+        later = self.note.modified + timedelta(days=1)
+        utils.bump_last_modified_date(later)
+        eq_(utils.get_last_modified_date(), later)
+
+    def test_bumped_on_note_releases(self):
+        """
+        Should move forward when the releases of a note change
+        """
+        before = utils.get_last_modified_date()
+        self.note.releases.add(self.release)
+        ok_(utils.get_last_modified_date() > before)
+
+    def test_empty(self):
+        """
+        Should return None without releases or notes
+        """
+        models.Note.objects.all().delete()
+        utils.reset_last_modified_date()
+        eq_(utils.get_last_modified_date(), None)
+
+    def test_bumped_on_save(self):
+        """
+        Should move forward when a release or note is saved
+        """
+        self.release.save()
+        eq_(utils.get_last_modified_date(), self.release.modified)
+        self.note.save()
+        eq_(utils.get_last_modified_date(), self.note.modified)
 
     @patch('rna.admin.ReleaseAdmin.message_user')
-    @patch('rna.admin.now')
-    def test_2nd_copy_releases(self, mock_now, mock_message_user):
-        mock_release_model = Mock()
-        mock_release_model.objects.filter.return_value.count.return_value = 2
-        release_admin = admin.ReleaseAdmin(mock_release_model, 'admin_site')
-        mock_release = Mock(id=1, version='42.0', product='Firefox')
-        mock_release.note_set.all.return_value = ['note']
-
-        release_admin.copy_releases('request', [mock_release])
-
-        mock_release_model.objects.filter.assert_called_once_with(
-            version__endswith='42.0', product='Firefox')
-        eq_(mock_release.id, None)
-        eq_(mock_release.version, 'copy2-42.0')
-        mock_release.save.assert_called_once_with()
-        mock_release.note_set.add.assert_called_once_with('note')
-        mock_release.note_set.update.assert_called_once_with(
-            modified=mock_now.return_value)
-        mock_message_user.assert_called_once_with('request', 'Copied Release')
+    def test_bumped_on_update(self, mock_message_user):
+        """
+        Should move forward when admin actions update releases or notes
+        """
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        release_admin.set_to_public('request', models.Release.objects.all())
+        eq_(utils.get_last_modified_date(),
+            models.Release.objects.get().modified)
+        self.note.releases.add(self.release)
+        release_admin.copy_releases('request', models.Release.objects.all())
+        eq_(utils.get_last_modified_date(),
+            utils.compute_last_modified_date())
+
+    @override_settings(RNA_LAST_MODIFIED_TTL=60)
+    def test_ttl(self):
+        """
+        Should keep the date in memory for RNA_LAST_MODIFIED_TTL seconds
+        """
+        utils.get_last_modified_date()
+        self.addCleanup(utils._last_modified.clear)
+        with patch('rna.utils.cache') as mock_cache:
+            eq_(utils.get_last_modified_date(), self.note.modified)
+            ok_(not mock_cache.get.called)
+
+    def test_rnarebuild(self):
+        """
+        Should recompute the date
+        """
+        old_date = datetime(2001, 1, 1)
+        models.Watermark.objects.update(modified=old_date)
+        cache.clear()
+        eq_(utils.get_last_modified_date(), old_date)
+        with patch('sys.stdout'):
+            call_command('rnarebuild', 'watermark')
+        eq_(utils.get_last_modified_date(), self.note.modified)
+
+
+class SyncFeedTest(TestCase):
+    def setUp(self):
+        self.release_1 = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.release_2 = models.Release.objects.create(
+            product='Firefox', channel='Beta', version='43.0beta',
+            release_date=datetime(2015, 11, 3))
+        self.note_1 = models.Note.objects.create(note='Shiny', bug=1)
+        self.note_1.releases.add(self.release_1, self.release_2)
+        self.note_2 = models.Note.objects.create(
+            note='Broken', is_known_issue=True, fixed_in_release=self.release_1)
+        self.note_2.releases.add(self.release_2)
+
+    def walk(self, cursor=None, limit=2):
+        pages = []
+        while True:
+            page = json.loads(sync.encode_changes(sync.get_changes(cursor, limit)))
+            pages.append(page)
+            cursor = page['cursor']
+            if not page['more']:
+                return pages
+
+    def keys(self, pages):
+        return [(c['model'], c['pk'], c.get('deleted', False))
+                for page in pages for c in page['changes']]
+
+    def test_get_changes(self):
+        """
+        Should page through every release and note in modified order
+        """
+        pages = self.walk()
+        eq_(len(pages), 2)
+        eq_(self.keys(pages), [
+            ('rna.release', self.release_1.pk, False),
+            ('rna.release', self.release_2.pk, False),
+            ('rna.note', self.note_1.pk, False),
+            ('rna.note', self.note_2.pk, False)])
+        eq_(pages[1]['changes'][0]['fields']['releases'],
+            sorted([self.release_1.pk, self.release_2.pk]))
+
+    def test_get_changes_since_cursor(self):
+        """
+        Should only return changes after the cursor, including tombstones
+        """
+        cursor = self.walk()[-1]['cursor']
+        eq_(self.walk(cursor)[0]['changes'], [])
+        self.note_1.save()
+        note_2_pk = self.note_2.pk
+        self.note_2.delete()
+        eq_(self.keys(self.walk(cursor)), [
+            ('rna.note', self.note_1.pk, False),
+            ('rna.note', note_2_pk, True)])
+
+    def test_get_changes_links(self):
+        """
+        Should return notes whose releases changed, from either side
+        """
+        def changed_notes(cursor):
+            return [pk for model, pk, deleted in self.keys(self.walk(cursor))
+                    if model == 'rna.note']
+
+        for change in (lambda: self.note_1.releases.remove(self.release_2),
+                       lambda: self.release_2.note_set.add(self.note_1),
+                       lambda: self.release_2.note_set.remove(self.note_1),
+                       lambda: self.note_1.releases.add(self.release_2),
+                       lambda: self.release_1.note_set.clear()):
+            cursor = self.walk()[-1]['cursor']
+            change()
+            eq_(changed_notes(cursor), [self.note_1.pk])
+
+    def test_get_changes_same_modified(self):
+        """
+        Should not skip or repeat rows with the same modified date
+        """
+        models.Release.objects.update(modified=self.release_1.modified)
+        models.Note.objects.update(modified=self.release_1.modified)
+        eq_(len(self.keys(self.walk(limit=1))), 4)
+
+    def test_get_changes_dependencies(self):
+        """
+        Should include releases referenced by notes in the page
+        """
+        self.release_1.save()
+        pages = self.walk(limit=3)
+        eq_(self.keys(pages), [
+            ('rna.release', self.release_1.pk, False),
+            ('rna.release', self.release_2.pk, False),
+            ('rna.note', self.note_1.pk, False),
+            ('rna.note', self.note_2.pk, False),
+            ('rna.release', self.release_1.pk, False)])
+
+    def test_invalid_cursor(self):
+        """
+        Should respond with 400 Bad Request
+        """
+        eq_(self.client.get('/sync/changes/', {'cursor': 'nope'}).status_code,
+            400)
+
+    def test_view(self):
+        """
+        Should respond with a page of changes
+        """
+        response = self.client.get('/sync/changes/', {'limit': 3})
+        eq_(response['Content-Type'], 'application/json')
+        page = json.loads(response.content)
+        ok_(page['more'])
+        eq_(len(page['changes']), 3)
+
+    def test_view_conditional(self):
+        """
+        Should respond with 304 Not Modified until something changes,
+        including deletes
+        """
+        response = self.client.get('/sync/changes/', {'limit': 3})
+        etag = response['ETag']
+        response = self.client.get('/sync/changes/', {'limit': 3},
+                                   HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 304)
+        response = self.client.get('/sync/changes/', {'limit': 2},
+                                   HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        self.note_2.delete()
+        response = self.client.get('/sync/changes/', {'limit': 3},
+                                   HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+
+    def test_view_gzip(self):
+        """
+        Should compress the feed and the dump for clients that accept gzip
+        """
+        for path in ('/sync/changes/', '/sync/'):
+            response = self.client.get(path, HTTP_ACCEPT_ENCODING='gzip')
+            eq_(response['Content-Encoding'], 'gzip')
+
+    def sync_from(self, by_cursor, clean=False):
+        """
+        Sync from a dict of cursor => page of changes, or an exception to
+        raise instead
+        """
+        def fetch(session, url, params, state):
+            page = by_cursor[params.get('cursor')]
+            if isinstance(page, Exception):
+                raise page
+            return Mock(headers={}, json=Mock(return_value=page))
+
+        with patch('rna.sync.fetch', side_effect=fetch):
+            return sync.sync_feed('http://upstream/sync/changes/', clean=clean)
+
+    def dump(self):
+        return ([r.to_dict() for r in models.Release.objects.all()],
+                [(n.note, list(n.releases.all())) for n in models.Note.objects.all()])
+
+    def test_sync_feed(self):
+        """
+        Should apply every page and store the cursor
+        """
+        expected = self.dump()
+        pages = self.walk()
+        models.Note.objects.all().delete()
+        models.Release.objects.all().delete()
+        models.Tombstone.objects.all().delete()
+        # 4 objects and 3 note releases
+        eq_(self.sync_from({None: pages[0], pages[0]['cursor']: pages[1]}), 7)
+        eq_(self.dump(), expected)
+        eq_(models.SyncState.objects.get().cursor, pages[-1]['cursor'])
+
+    def test_sync_feed_resume(self):
+        """
+        Should continue after the last page applied
+        """
+        pages = self.walk()
+        sync.delete_all()
+        with self.assertRaises(RuntimeError):
+            self.sync_from({None: pages[0], pages[0]['cursor']: RuntimeError()})
+        eq_(models.SyncState.objects.get().cursor, pages[0]['cursor'])
+        eq_(self.sync_from({pages[0]['cursor']: pages[1]}), 5)
+
+    def test_sync_feed_clean(self):
+        """
+        Should replace everything without recording tombstones
+        """
+        expected = self.dump()
+        pages = self.walk()
+        eq_(self.sync_from({None: pages[0], pages[0]['cursor']: pages[1]},
+                           clean=True), 7)
+        eq_(self.dump(), expected)
+        eq_(models.Tombstone.objects.count(), 0)
+
+    def test_delete_all(self):
+        """
+        Should delete everything with a query per table, not per row
+        """
+        models.RenderedRelease.objects.refresh([self.release_1.pk])
+        with self.assertNumQueries(9):
+            sync.delete_all()
+        for model in (models.Release, models.Note, models.RenderedRelease,
+                      models.BugRelease, models.Tombstone):
+            eq_(model.objects.count(), 0)
+        eq_(search.search_ids(models.Note, 'shiny'), [])
+
+    def test_prune_tombstones(self):
+        """
+        Should delete tombstones older than RNA_TOMBSTONE_RETENTION days
+        """
+        self.note_2.delete()
+        self.release_2.delete()
+        models.Tombstone.objects.filter(model_label='rna.note').update(
+            modified=datetime.now() - timedelta(days=91))
+        with patch('sys.stdout'):
+            call_command('rnarebuild', 'tombstones')
+        eq_(list(models.Tombstone.objects.values_list('model_label', flat=True)),
+            ['rna.release'])
+        with self.settings(RNA_TOMBSTONE_RETENTION=0):
+            eq_(models.Tombstone.objects.prune(), 1)
+
+    def test_apply_changes_updates(self):
+        """
+        Should update existing rows, replace note releases and delete,
+        with a number of queries that does not grow with the page
+        """
+        changes = self.walk(limit=10)[0]['changes']
+        changes[0]['fields']['version'] = '42.0.1'
+        changes[2]['fields']['releases'] = [self.release_2.pk]
+        for change in changes[0], changes[2]:
+            change['fields']['modified'] = '2030-01-01T00:00:00'
+        changes.append({'model': 'rna.note', 'pk': self.note_2.pk,
+                        'deleted': True})
+        with self.assertNumQueries(38):
+            eq_(sync.apply_changes(changes), 4)
+        release = models.Release.objects.get(pk=self.release_1.pk)
+        eq_(release.version, '42.0.1')
+        eq_(release.version_key, models.get_version_key('42.0.1'))
+        eq_(list(self.note_1.releases.all()), [self.release_2])
+        ok_(not models.Note.objects.filter(pk=self.note_2.pk).exists())
+        ok_(not models.Tombstone.objects.exists())
+
+    def test_apply_changes_unchanged(self):
+        """
+        Should skip rows whose modified date is unchanged, keeping what is
+        derived from them
+        """
+        changes = self.walk(limit=10)[0]['changes']
+        models.RenderedRelease.objects.refresh([self.release_1.pk])
+        eq_(sync.apply_changes(changes), 0)
+        ok_(models.RenderedRelease.objects.filter(
+            release=self.release_1).exists())
+        changes[1]['fields']['modified'] = '2030-01-01T00:00:00'
+        eq_(sync.apply_changes(changes), 1)
+        ok_(models.RenderedRelease.objects.filter(
+            release=self.release_1).exists())
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers))
+        status, headers, body = self.server.responses.pop(0)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+                fp.write(body)
+            body = buf.getvalue()
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SyncClientTest(TestCase):
+    def setUp(self):
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.note = models.Note.objects.create(note='Shiny')
+        self.note.releases.add(self.release)
+        self.dump = sync.encode_changes(sync.serialize_changes(
+            [self.release, self.note]))
+
+        self.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.requests = []
+        self.server.responses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/sync/'.format(self.server.server_port)
+
+    def test_sync_dump(self):
+        """
+        Should apply the gzipped dump, then skip it while it is not modified
+        """
+        models.Release.objects.all().delete()
+        self.server.responses = [
+            (200, {'ETag': '"abc"',
+                   'Last-Modified': 'Tue, 03 Nov 2015 00:00:00 GMT'}, self.dump),
+            (304, {}, '')]
+        eq_(sync.sync_dump(self.url), 3)
+        eq_(list(models.Note.objects.get().releases.all()),
+            [models.Release.objects.get()])
+        eq_(sync.sync_dump(self.url), 0)
+
+        (path, first), (path, second) = self.server.requests
+        ok_('gzip' in first['Accept-Encoding'])
+        ok_('If-None-Match' not in first)
+        eq_(second['If-None-Match'], '"abc"')
+        eq_(second['If-Modified-Since'], 'Tue, 03 Nov 2015 00:00:00 GMT')
+
+    def test_sync_feed_retry(self):
+        """
+        Should retry a failed request
+        """
+        self.server.responses = [
+            (503, {}, ''),
+            (200, {}, json.dumps({'cursor': None, 'more': False,
+                                  'changes': []}))]
+        session = sync.get_session(backoff_factor=0)
+        eq_(sync.sync_feed(self.url + 'changes/', session=session), 0)
+        eq_(len(self.server.requests), 2)
+
+
+class BenchTest(TestCase):
+    def test_generate(self):
+        """
+        Should generate the requested dataset, the same for the same seed
+        """
+        from . import bench
+        bench.generate(releases=10, notes=3, fanout=2, seed=1)
+        eq_(models.Release.objects.count(), 10)
+        eq_(models.Note.objects.count(), 30)
+        eq_(models.Note.releases.through.objects.count(), 60)
+        eq_(models.RenderedRelease.objects.count(), 10)
+        notes = list(models.Note.objects.values_list('note', 'bug'))
+        models.Release.objects.all().delete()
+        models.Note.objects.all().delete()
+        bench.generate(releases=10, notes=3, fanout=2, seed=1)
+        eq_(list(models.Note.objects.values_list('note', 'bug')), notes)
+
+    def test_benchmarks(self):
+        """
+        Should run every benchmark
+        """
+        from . import bench
+        bench.generate(releases=5, notes=2)
+        for name, func in bench.get_benchmarks():
+            ok_(bench.measure(func, 1)['min'] >= 0, name)